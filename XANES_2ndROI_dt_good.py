@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+__version__ = "2.0"
+
 import glob
 import h5py
 import itertools
@@ -9,6 +11,12 @@ import os
 import sys
 import time
 
+from deadtime import deadtime_stats, sirius_deadtime
+from h5_batch import batch_arguments, run_batch
+from h5_io import read_array
+from h5_manifest import add_manifest_arguments
+from roi_integration import add_roi_arguments, alfafluo, cached_prefix_sum, integrate_prefix, integrate_rois, roi_name, rois_from_arguments
+
 NEW_FOLDER = '/2nd_Roi/'
 EXT = 'h5'
 
@@ -18,7 +26,9 @@ Co_roi = [660,700,600,644]
 
 separator = ' '
 
-def process_hdf_file(file_name, out_path, include_motors = False):
+# rois: list of [first, last] ROIs to integrate. If None, the Fe or Co couple above is chosen from the filename.
+# prefix_cache: save/reuse the cumulative spectrum next to the h5 file (fast when trying many ROIs)
+def process_hdf_file(file_name, out_path, include_motors = False, rois = None, prefix_cache = False):
     src_file = file_name
     deadtime_high = False
 
@@ -78,44 +88,38 @@ def process_hdf_file(file_name, out_path, include_motors = False):
             got_keithley = False
             
         try:                                
-            array_new = np.array(f['sirius3/sum_spectrum'])
+            if prefix_cache:
+                prefix = cached_prefix_sum(f, 'sirius3/sum_spectrum')
+            else:
+                array_new = read_array(f['sirius3/sum_spectrum'])
             got_fluo = True
 
-            counts_roi1 = []
-            counts_selfabs = []
-            alfafluo_roi1 = []            
-            alfafluo_selfabs = []
-
-            if 'Co' in src_file:
-                Roi = Co_roi
+            if rois is not None:
+                roi_string = ''.join([', a_fluo_%s' %roi_name(r) for r in rois])
+            elif 'Co' in src_file:
+                rois = [Co_roi[0:2], Co_roi[2:4]]
                 roi_string = ', a_fluo_Co, a_fluo_Fe(SelfAbsCorr)'         
             elif 'Fe' in src_file:
-                Roi = Fe_roi
+                rois = [Fe_roi[0:2], Fe_roi[2:4]]
                 roi_string = ', a_fluo_Fe, a_fluo_(SelfAbsCorr)'         
             else:
                 print('- - - - Co or Fe edge not detected from filename!!! - - -')
+                raise ValueError('no ROI for this file')
 
-            for i in range(points):
-                counts_roi1.append( np.sum(array_new[i][Roi[0]:Roi[1]+1]) )
-                counts_selfabs.append( np.sum(array_new[i][Roi[2]:Roi[3]+1]) )
-
-                alfafluo_roi1.append( counts_roi1[i] / bms[i])
-                alfafluo_selfabs.append( counts_selfabs [i] / bms[i])
+            # all the ROIs, all the points at once
+            if prefix_cache:
+                alfafluo_rois = alfafluo(integrate_prefix(prefix[0:points], rois), bms[0:points])
+            else:
+                alfafluo_rois = alfafluo(integrate_rois(array_new[0:points], rois), bms[0:points])
             
             title_string += roi_string
 
         ########  DEADTIME CHECK ########################
 
-            deadtime_u = np.array(f['sirius3/up_deadtimepct'])
-            deadtime_u = np.round(deadtime_u,1)
-            deadtime_m = np.array(f['sirius3/mid_deadtimepct'])
-            deadtime_m = np.round(deadtime_m,1)
-            deadtime_d = np.array(f['sirius3/down_deadtimepct'])
-            deadtime_d = np.round(deadtime_d,1)
+            # the three elements at once (see deadtime.py)
+            deadtime_u, deadtime_m, deadtime_d = np.round(sirius_deadtime(f), 1)
 
-            deadtime_max = np.amax([deadtime_u, deadtime_m, deadtime_d])
-                      
-            if deadtime_max > 10:
+            if deadtime_stats([deadtime_u, deadtime_m, deadtime_d])['high']:
                 deadtime_high = True
                 title_string += ', dt_u (%), dt_m (%), dt_d (%)\n'
                 title_string += '# watch out for the deadtime (dt)!!'
@@ -128,7 +132,7 @@ def process_hdf_file(file_name, out_path, include_motors = False):
 
         except Exception as e:
             got_fluo = False
-            print 'Bruker/Sirius error:', e.message
+            print('Bruker/Sirius error:', e)
 
         title_string += '\n'
 
@@ -159,16 +163,19 @@ def process_hdf_file(file_name, out_path, include_motors = False):
                 if got_keithley:
                     data_line = separator.join([data_line, str(np.round(alphatrans[i], 4))])
                 if got_fluo:
-                    data_line = separator.join([data_line, str(np.round(alfafluo_roi1[i],0))])
-                    data_line = separator.join([data_line, str(np.round(alfafluo_selfabs[i],0))])
+                    for value in alfafluo_rois[i]:
+                        data_line = separator.join([data_line, str(np.round(value,0))])
                 if deadtime_high:
                    data_line = separator.join([data_line, str(deadtime_u[i]), str(deadtime_m[i]), str(deadtime_d[i])])
 
                 tf.write(data_line + '\n')
             print ('Saved file', target_file)
+    return [target_file]
 
         
-if __name__ == "__main__":
+# Files already processed with the same version and ROIs are skipped (see h5_manifest), unless force=True.
+# file_list: the scans to process (default: all the h5 files in the current folder)
+def run(workers=None, rois=None, prefix_cache=False, force=False, file_list=None):
 
     print('-------------------------------------------------\n')
     print('---------           Welcome!         ------------\n')
@@ -181,8 +188,9 @@ if __name__ == "__main__":
     # out_path = str(input('Where do you want to save the reshaped maps?' ))
     
     # checks automatically all the h5 files in the in_path 
-    file_list = glob.glob('{0}/*'.format(in_path)+EXT)
-    print('I found '+str(len(file_list))+' files matching the extension '+EXT)
+    if file_list is None:
+        file_list = [filename[2:] for filename in glob.glob('{0}/*'.format(in_path)+EXT)]
+        print('I found '+str(len(file_list))+' files matching the extension '+EXT)
     print(file_list)
     print('\n')
     
@@ -196,13 +204,18 @@ if __name__ == "__main__":
 
         if not os.path.exists(out_path):
             os.makedirs(out_path)
-        
-        for filename, i in zip(file_list, range(len(file_list))):
-            filename = filename[2:]
-            print(filename)
-            include_motors = False
-            process_hdf_file(filename, out_path, include_motors)
 
-            print('\n --> Data {0}/{1} successfully processed.\n'.format(i+1, len(file_list)))
+        # the cached prefix sums give the same results: prefix_cache is not a parameter of the outputs
+        params = {'rois': rois, 'Fe_roi': Fe_roi, 'Co_roi': Co_roi, 'include_motors': False}
+        run_batch(process_hdf_file, file_list, out_path, workers, label='Data', manifest=('xanes', __version__, params),
+                  force=force, include_motors=False, rois=rois, prefix_cache=prefix_cache)
 
-    print('\n --> Have a nice day!')
\ No newline at end of file
+    print('\n --> Have a nice day!')
+
+if __name__ == "__main__":
+    parser = batch_arguments('Extract XANES spectra with the Fe/Co and self-absorption ROIs from the h5 files in the current folder.')
+    add_roi_arguments(parser)
+    add_manifest_arguments(parser)
+    args = parser.parse_args()
+    # without --roi/--roi-file, the Fe or Co ROIs defined above are used
+    run(args.workers, rois_from_arguments(args) or None, args.prefix_cache, args.force)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Benchmarks of the scripts on synthetic files (see synthetic_h5.py).
+# For each stage and map size it reports wall time, throughput (pixels/s and MB/s of raw spectra)
+# and peak memory (RSS). Each measurement runs in a new process, so the peak memory is the stage's own.
+#
+# usage: python benchmark.py [--sizes 100 300] [--stages reshape normalise orange roi] [--repeat 3] [--output results.csv]
+
+import argparse
+import importlib.util
+import multiprocessing
+import os
+import queue as queue_module
+import shutil
+import sys
+import tempfile
+import time
+
+import synthetic_h5
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ('reshape', 'normalise', 'orange', 'roi')
+
+
+# the scripts are loaded from their file, as some names (reshape-cut-rotate_v5) are not valid module names
+def _load_script(file_name):
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    name = os.path.splitext(file_name)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _run_stage(stage, file_name, out_path):
+    if stage == 'reshape':
+        _load_script('reshape-cut-rotate_v5.py').cut_reshape(file_name, out_path)
+    elif stage == 'normalise':
+        _load_script('normalise_bms_LT_pixels.py').normalise_h5(file_name, out_path)
+    elif stage == 'orange':
+        _load_script('convert_h5_to_orange.py').convert(file_name, out_path)
+    elif stage == 'roi':
+        _load_script('XANES_2ndROI_dt_good.py').process_hdf_file(file_name, out_path)
+
+
+def _peak_rss_mb():
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 1024**2 if sys.platform == 'darwin' else rss / 1024
+
+
+def _child(stage, file_name, out_path, queue):
+    os.chdir(os.path.dirname(file_name))
+    out_path = os.path.relpath(out_path) + os.sep
+    file_name = os.path.basename(file_name)
+    # the outputs of the previous repetition are removed, so that every run does the same work
+    shutil.rmtree(out_path, ignore_errors=True)
+    os.makedirs(out_path)
+    sys.stdout = open(os.devnull, 'w')
+    start = time.perf_counter()
+    try:
+        _run_stage(stage, file_name, out_path)
+        error = None
+    except Exception as e:
+        error = '%s: %s' %(type(e).__name__, e)
+    queue.put((time.perf_counter() - start, _peak_rss_mb(), error))
+
+
+def measure(stage, file_name, out_path):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(stage, file_name, out_path, queue))
+    process.start()
+    # the result is a few bytes: it can wait in the queue until the process ends
+    process.join()
+    try:
+        return queue.get(timeout=5)
+    except queue_module.Empty:
+        return float('nan'), float('nan'), 'process ended with exit code %s' %process.exitcode
+
+
+def make_input(stage, size, channels, work_dir):
+    if stage == 'roi':
+        file_name = os.path.join(work_dir, 'Fe_xanes_%d.h5' %(size*size))
+        if not os.path.exists(file_name):
+            synthetic_h5.make_xanes(file_name, points=size*size, channels=channels)
+        return file_name, size*size, size*size*channels*4
+    file_name = os.path.join(work_dir, 'map_%dx%d.h5' %(size, size))
+    if not os.path.exists(file_name):
+        synthetic_h5.make_map(file_name, rows=size, cols=size, channels=channels, sample='bench%d' %size)
+    return file_name, size*size, size*size*channels*4
+
+
+def run(sizes, stages, channels, repeat, work_dir, output=None):
+    rows = []
+    print('%-10s %12s %10s %12s %10s %12s  %s' %('stage', 'pixels', 'time (s)', 'pixels/s', 'MB/s', 'peak RSS (MB)', ''))
+    for size in sizes:
+        for stage in stages:
+            file_name, pixels, raw_bytes = make_input(stage, size, channels, work_dir)
+            out_path = os.path.join(work_dir, 'out_' + stage)
+            times, peaks, error = [], [], None
+            for i in range(repeat):
+                seconds, peak, error = measure(stage, file_name, out_path)
+                times.append(seconds)
+                peaks.append(peak)
+            best = min(times)
+            row = (stage, pixels, best, pixels/best, raw_bytes/1e6/best, max(peaks), error or '')
+            rows.append(row)
+            print('%-10s %12d %10.3f %12.0f %10.1f %12.1f  %s' %row)
+
+    if output:
+        with open(output, 'w') as out:
+            out.write('stage,pixels,seconds,pixels_per_s,mb_per_s,peak_rss_mb,error\n')
+            for row in rows:
+                out.write('%s,%d,%.4f,%.1f,%.2f,%.1f,%s\n' %row)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the h5 scripts on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 150],
+                        help='side of the square maps (pixels); XANES scans get size*size points')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--channels', type=int, default=synthetic_h5.CHANNELS)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per measurement, the best time is reported')
+    parser.add_argument('--work-dir', default=None, help='folder for the synthetic files (default: temporary)')
+    parser.add_argument('--output', default=None, help='save the results to this csv file')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='h5_benchmark_')
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    work_dir = os.path.abspath(work_dir)
+    try:
+        run(args.sizes, args.stages, args.channels, args.repeat, work_dir, args.output)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -8,6 +8,10 @@ import os
 import sys
 import time
 
+from h5_batch import batch_arguments, run_batch
+from h5_io import dataset_view
+from h5_map_handling_v2 import for_each_run, run_suffix
+
 separator = ' '
 DECIMALS = 6
 EXT = "h5"
@@ -15,35 +19,126 @@ PATH_SCALAR = "/Measurement/TransientScalarData/"
 PATH_VECTOR = "/Measurement/TransientVectorData/"
 NEW_FOLDER = "/convert/"
 BMS_channel = "BMS-3"
+CHANNELS = 2048
+# pixels read from the h5 file and written to the csv at once
+BLOCK_PIXELS = 2048
+FORMATS = ('csv', 'npy', 'parquet', 'arrow')
+CSV_TITLE = '# x, y, bms, spectrum'
 
 
-def convert(map_name, out_path):
-    
-    txt_file_name = map_name.split('/')[-1].split('.')
-    txt_file_name[-1] = 'txt'
-    txt_file = os.path.join( out_path, map_name.split('.')[0] + '.csv')  
-
-    with h5py.File(map_name, 'r') as f, open(txt_file, 'w') as txt:
-        run = f.keys()[0]
-        x = f[run+PATH_SCALAR+"X"][...]
-        y = f[run+PATH_SCALAR+"Y"][...]
-        
-        bms = f[run+PATH_VECTOR+BMS_channel][...]
-        bms = bms.mean(axis=1)
-        
-        spectra = f[run+PATH_VECTOR+"SDD#1-Spectra"][...]            
-        
-        map = zip(x,y,bms)
-        
-        title_string = '# x, y, bms, spectrum'
-        txt.write(title_string)
-        
-        for i in range(len(x)):
-            txt.write('\n{},{},{}'.format(map[i][0],map[i][1],map[i][2]))
-            for ch in range(2048):
-                txt.write(',{}'.format(spectra[i][ch]))
+# the values as python objects to be formatted: same text as formatting each numpy value
+# (a float32 0.1 stays '0.1', while its python float would be 0.10000000149011612)
+def _values(values):
+    if values.dtype.kind in 'iub':
+        return values.tolist()
+    return values.astype(str).tolist()
+
+
+# text of a block of values, one string per pixel: 'v0,v1,v2,...'
+def _format_block(values):
+    return [','.join(map(str, row)) for row in _values(values)]
+
+
+def _map_blocks(f, run):
+    x = f[run+PATH_SCALAR+"X"][...]
+    y = f[run+PATH_SCALAR+"Y"][...]
+    bms = dataset_view(f[run+PATH_VECTOR+BMS_channel])
+    spectra = dataset_view(f[run+PATH_VECTOR+"SDD#1-Spectra"])
+
+    for start in range(0, len(x), BLOCK_PIXELS):
+        stop = min(start + BLOCK_PIXELS, len(x))
+        yield x[start:stop], y[start:stop], bms[start:stop].mean(axis=1), spectra[start:stop, 0:CHANNELS]
+
+
+# csv text of a block of pixels: one line 'x,y,bms,ch0,ch1,...' per pixel, each starting with a newline
+def csv_block(x, y, bms, spectra):
+    pixels = zip(_values(x), _values(y), _values(bms), _format_block(spectra))
+    return ''.join(['\n{},{},{},{}'.format(*pixel) for pixel in pixels])
+
+
+def _write_csv(blocks, out_file):
+    with open(out_file, 'w') as txt:
+        txt.write(CSV_TITLE)
+
+        for x, y, bms, spectra in blocks:
+            txt.write(csv_block(x, y, bms, spectra))
+
+
+# One .npy file per column (x, y, bms, spectra) in a folder: np.load(..., mmap_mode='r') reads them without parsing.
+def _write_npy(blocks, out_folder, points, channels, dtype):
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    columns = {'x': np.lib.format.open_memmap(os.path.join(out_folder, 'x.npy'), 'w+', float, (points,)),
+               'y': np.lib.format.open_memmap(os.path.join(out_folder, 'y.npy'), 'w+', float, (points,)),
+               'bms': np.lib.format.open_memmap(os.path.join(out_folder, 'bms.npy'), 'w+', float, (points,)),
+               'spectra': np.lib.format.open_memmap(os.path.join(out_folder, 'spectra.npy'), 'w+', dtype, (points, channels))}
+    start = 0
+    for block in blocks:
+        stop = start + len(block[0])
+        for name, values in zip(('x', 'y', 'bms', 'spectra'), block):
+            columns[name][start:stop] = values
+        start = stop
+    for column in columns.values():
+        column.flush()
+
+
+# Arrow (feather) or Parquet table with the columns x, y, bms, ch0 ... ch2047. Needs pyarrow.
+def _write_arrow(blocks, out_file, parquet, channels):
+    import pyarrow as pa
+    import pyarrow.ipc
+    if parquet:
+        import pyarrow.parquet as pq
+
+    names = ['x', 'y', 'bms'] + ['ch%d' %ch for ch in range(channels)]
+    writer = None
+    try:
+        for x, y, bms, spectra in blocks:
+            arrays = [pa.array(x), pa.array(y), pa.array(bms)]
+            arrays += [pa.array(np.ascontiguousarray(spectra[:, ch])) for ch in range(spectra.shape[1])]
+            table = pa.Table.from_arrays(arrays, names=names)
+            if writer is None:
+                if parquet:
+                    writer = pq.ParquetWriter(out_file, table.schema)
+                else:
+                    writer = pa.ipc.new_file(out_file, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _pyarrow_missing():
+    try:
+        import pyarrow
+    except ImportError:
+        return True
+    return False
+
+
+# The spectra are read and written in blocks of BLOCK_PIXELS pixels:
+# memory does not depend on the map size, and each block is formatted with a few calls.
+# fmt is one of FORMATS: csv (Orange text file), npy (folder of .npy files), parquet or arrow (need pyarrow).
+# run: key of the run; by default all the runs of the file, one output for each run (_run1, _run2, ...).
+def convert(map_name, out_path, fmt='csv', run=None):
+    if run is None:
+        return for_each_run(convert, map_name, out_path, fmt=fmt)
+
+    with h5py.File(map_name, 'r') as f:
+        out_name = os.path.join( out_path, map_name.split('.')[0] + run_suffix(f, run))
+        if fmt == 'csv':
+            _write_csv(_map_blocks(f, run), out_name + '.csv')
+        elif fmt == 'npy':
+            spectra = f[run+PATH_VECTOR+"SDD#1-Spectra"]
+            points = f[run+PATH_SCALAR+"X"].shape[0]
+            channels = min(CHANNELS, spectra.shape[1])
+            _write_npy(_map_blocks(f, run), out_name + '_npy', points, channels, spectra.dtype)
+        elif fmt in ('parquet', 'arrow'):
+            channels = min(CHANNELS, f[run+PATH_VECTOR+"SDD#1-Spectra"].shape[1])
+            _write_arrow(_map_blocks(f, run), out_name + '.' + fmt, fmt == 'parquet', channels)
+        else:
+            raise ValueError('Unknown output format: %s' %fmt)
             
-def run():
+def run(workers=None, fmt='csv'):
     print('-------------------------------------------------\n')
     print('---------           Welcome!         ------------\n')
     print("---        Converting maps to csv !           ---\n")
@@ -62,18 +157,23 @@ def run():
         print("--> Can't do much with 0 files! Sorry!")
         print("--> Move the maps in the same folder as the program and try again!")
     
+    elif fmt in ('parquet', 'arrow') and _pyarrow_missing():
+        print("--> The %s format needs the python package pyarrow: install it or choose csv/npy." %fmt)
+
     else: 
-        print("--> All these files will be converted. \n")
+        print("--> All these files will be converted (%s). \n" %fmt)
         
         if not os.path.exists(out_path):
             os.makedirs(out_path)
             
-        for filename, i in zip(file_list, range(len(file_list))):
-            filename = filename[2:]
-            convert(filename, out_path)
-            print('\n --> Map {0}/{1} successfully converted.\n'.format(i+1, len(file_list)))
+        file_list = [filename[2:] for filename in file_list]
+        run_batch(convert, file_list, out_path, workers, label='Map', per_run=True, fmt=fmt)
 
         print('\n --> Have a nice day!')
 
 if __name__ == "__main__":
-    run()            
+    parser = batch_arguments('Convert the XRF maps in the current folder to Orange-compatible csv files.')
+    parser.add_argument('--format', dest='fmt', choices=FORMATS, default='csv',
+                        help='csv (default), npy (folder of memory-mappable .npy files), parquet or arrow (need pyarrow)')
+    args = parser.parse_args()
+    run(args.workers, args.fmt)            
@@ -7,6 +7,8 @@ import os
 import sys
 import time
 
+from deadtime import bruker_deadtime, deadtime_stats
+
 separator = ' '
 DECIMALS = 3
 
@@ -75,13 +77,9 @@ def process_hdf_file(file_name, include_motors = False):
             title_string += roi_string
             title_string += ', deadtime (%)'
             got_bruker = True
-            acq_time = f['bruker/acquisitiontime'][()]
-            deadtime = []
-            livetime = np.array(f['bruker/livetime'])
-            for i in range(len(triggers)):
-                dt = ( (acq_time - livetime[i]) / acq_time * 100)
-                deadtime.append(dt)
-            if np.amax(deadtime) > 10:
+            # all the points at once (see deadtime.py)
+            deadtime = bruker_deadtime(f)[0:len(triggers)]
+            if deadtime_stats(deadtime)['high']:
                 print ('Max deadtime exceeded 10%! Inspect data with care!\n')
             else:
                 print ('Deadtime <10% in the whole dataset.')
@@ -112,7 +110,7 @@ def process_hdf_file(file_name, include_motors = False):
                     data_line = separator.join([data_line, str(roi4[i]), str(alfafluo4[i])])
                 data_line = separator.join([data_line, str(deadtime[i])])
             tf.write(data_line + '\n')
-        print 'Saved file', target_file
+        print('Saved file', target_file)
 
         
 if __name__ == "__main__":
@@ -125,6 +123,6 @@ if __name__ == "__main__":
         process_hdf_file(name_file, include_motors)
     except Exception as e:
         # print e.message
-        print 'Which file?'
+        print('Which file?')
     
         
\ No newline at end of file
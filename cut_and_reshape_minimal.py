@@ -14,7 +14,7 @@ import numpy as np
 import os
 import sys
 
-from mylib import count_steps, check_bms
+from h5maps import count_steps, check_bms
 
 
 BMS_MIN = 1e-2
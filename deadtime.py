@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Deadtime (%) of the fluorescence detectors, the same way for XANES scans and XRF maps,
+# for all the points at once (no loop on the points).
+# XANES scans:
+#   Bruker      (acquisition time - livetime) / acquisition time, for each point
+#   Sirius3     the deadtime of each element (up, mid, down) saved by the acquisition
+# XRF maps: one deadtime for each pixel and each element (SDD#1, SIRIUS3-UP, ...) from its LiveTime:
+#   - with the RealTime of the element (e.g. SDD#1-RealTime), if the acquisition saved it:
+#     (RealTime - LiveTime) / RealTime
+#   - otherwise relative to the pixel with the longest LiveTime of the map:
+#     (max LiveTime - LiveTime) / max LiveTime. The dwell time is the same for all the pixels, so this shows
+#     where the deadtime is higher; it is a lower limit (the best pixel counts as 0%).
+# deadtime_stats gives mean, maximum and the points above the limit; flags are deadtime > limit.
+
+import numpy as np
+
+# % above which the data have to be checked
+DEADTIME_MAX = 10.
+PATH_SCALAR = "/Measurement/TransientScalarData/"
+SIRIUS_ELEMENTS = ('up', 'mid', 'down')
+
+
+def deadtime_pct(livetime, real_time):
+    livetime = np.asarray(livetime, dtype=np.float64)
+    real_time = np.asarray(real_time, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deadtime = (real_time - livetime) / real_time * 100
+    # no time measured: no deadtime
+    return np.where(real_time > 0, deadtime, 0.)
+
+
+# deadtime: array of one or more elements (any shape)
+def deadtime_stats(deadtime, limit=DEADTIME_MAX):
+    deadtime = np.asarray(deadtime)
+    over = int(np.count_nonzero(deadtime > limit))
+    return {'mean': float(deadtime.mean()), 'max': float(deadtime.max()), 'over': over,
+            'fraction': over / float(deadtime.size), 'high': over > 0}
+
+
+# deadtime of each point of a XANES scan, Bruker detector
+def bruker_deadtime(h5file):
+    return deadtime_pct(h5file['bruker/livetime'][...], h5file['bruker/acquisitiontime'][()])
+
+
+# deadtime of each point of a XANES scan, Sirius3 detector: (3, points) array, one row for each element
+def sirius_deadtime(h5file):
+    return np.array([h5file['sirius3/%s_deadtimepct' %e][...] for e in SIRIUS_ELEMENTS], dtype=np.float64)
+
+
+# {element: (deadtime of each pixel, reference)} of a raw map, reference = 'RealTime' or 'max LiveTime'
+def map_deadtime(h5file, run):
+    scalar = h5file[run+PATH_SCALAR]
+    deadtimes = {}
+    for name in scalar.keys():
+        if not name.endswith('-LiveTime'):
+            continue
+        element = name[:-len('-LiveTime')]
+        livetime = np.array(scalar[name][...], dtype=np.float64).reshape(-1)
+        if element + '-RealTime' in scalar:
+            real_time = np.array(scalar[element + '-RealTime'][...], dtype=np.float64).reshape(-1)
+            deadtimes[element] = (deadtime_pct(livetime, real_time), 'RealTime')
+        else:
+            deadtimes[element] = (deadtime_pct(livetime, livetime.max()), 'max LiveTime')
+    return deadtimes
+
+
+# comment lines for the elements above the limit ('' if none)
+def deadtime_comments(deadtimes, limit=DEADTIME_MAX):
+    comments = ''
+    for element, (deadtime, reference) in sorted(deadtimes.items()):
+        stats = deadtime_stats(deadtime, limit)
+        if stats['high']:
+            comments += ('Deadtime of %s above %g%% in %d pixels (max %.1f%%, relative to the %s).\n'
+                         %(element, limit, stats['over'], stats['max'], reference))
+    return comments
+
+
+# Writes the deadtime maps (reshaped like the spectra, see reshape_scalar) in run/Deadtime/<element>,
+# with their statistics as attributes.
+def write_deadtime_maps(fout, run, deadtimes, reshape, limit=DEADTIME_MAX):
+    for element, (deadtime, reference) in deadtimes.items():
+        values = reshape(deadtime)
+        dset = fout.create_dataset(run+"/Deadtime/"+element, data=values.astype(np.float32))
+        stats = deadtime_stats(values, limit)
+        dset.attrs['units'] = '%'
+        dset.attrs['reference'] = reference
+        dset.attrs['limit'] = limit
+        for key in ('mean', 'max', 'over'):
+            dset.attrs[key] = stats[key]
@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import argparse
 import h5py
 import numpy as np
 import os
 import sys
 import time
 
+from deadtime import bruker_deadtime
+from h5_io import read_array
+from roi_integration import add_roi_arguments, alfafluo, cached_prefix_sum, integrate_prefix, integrate_rois, parse_roi, roi_name, rois_from_arguments
+
 separator = ' '
 DECIMALS = 3
 
-def process_hdf_file(file_name, roi, include_motors = False):
+# roi can be a single ROI [first, last] or a list of ROIs: all of them are integrated at once
+# prefix_cache: save/reuse the cumulative spectrum next to the h5 file (fast when trying many ROIs)
+def process_hdf_file(file_name, roi, include_motors = False, prefix_cache = False):
+    rois = np.asarray(roi, dtype=int).reshape(-1, 2).tolist()
     src_file = file_name
     target_file_name = file_name.split('/')[-1].split('.')
     target_file_name[-1] = 'txt'
@@ -48,23 +56,23 @@ def process_hdf_file(file_name, roi, include_motors = False):
             got_keithley = False
         # print 'got_keithley', got_keithley
         try:                      
-            roi_string = ', roi_new, a_fluo_new'                    
-            array_new = np.array(f['bruker/spectrum'])
-            roi_new = []
-            alfafluo_new = []            
-            for point in range(len(triggers)):
-                roi_new.append( np.sum(array_new[point][roi[0]:roi[1]+1]) )
-                alfafluo_new.append( roi_new [point] / bms[point])
+            if len(rois) == 1:
+                roi_string = ', roi_new, a_fluo_new'                    
+            else:
+                roi_string = ''.join([', roi_%s, a_fluo_%s' %(roi_name(r), roi_name(r)) for r in rois])
+            points = len(triggers)
+            if prefix_cache:
+                roi_new = integrate_prefix(cached_prefix_sum(f, 'bruker/spectrum')[0:points], rois)
+            else:
+                array_new = read_array(f['bruker/spectrum'])[0:points]
+                roi_new = integrate_rois(array_new, rois)
+            alfafluo_new = alfafluo(roi_new, bms[0:points])
             
             title_string += roi_string
             title_string += ', deadtime (%)'
             got_bruker = True
-            acq_time = f['bruker/acquisitiontime'][()]
-            deadtime = []
-            livetime = np.array(f['bruker/livetime'])
-            for i in range(len(triggers)):
-                dt = ( (acq_time - livetime[i]) / acq_time * 100)
-                deadtime.append(dt)            
+            # all the points at once (see deadtime.py)
+            deadtime = bruker_deadtime(f)[0:len(triggers)]
         except Exception as e:
             got_bruker = False
             # print 'Bruker error:', e.message
@@ -82,23 +90,32 @@ def process_hdf_file(file_name, roi, include_motors = False):
             if got_keithley:
                 data_line = separator.join([data_line, str(np.round(keithley[i], DECIMALS)), str(np.round(alphatrans[i], DECIMALS))])
             if got_bruker:
-                data_line = separator.join([data_line, str(roi_new[i]), str(np.round(alfafluo_new[i],DECIMALS))])
+                for r in range(len(rois)):
+                    data_line = separator.join([data_line, str(roi_new[i][r]), str(np.round(alfafluo_new[i][r],DECIMALS))])
                 data_line = separator.join([data_line, str(deadtime[i])])
             tf.write(data_line + '\n')
-        print 'Saved file', target_file
+        print('Saved file', target_file)
 
         
 if __name__ == "__main__":
-    #usage: ./sys.argv[0] path_of_file
-    new_roi = input('First and last channel of the new ROI? [min, max]\n' )   
-    try:
-        include_motors = False
-        name_file = sys.argv[1]
-        if len(sys.argv) == 3:
-            include_motors = eval(sys.argv[2])
-        process_hdf_file(name_file, new_roi, include_motors)
-    except Exception as e:
-        # print e.message
-        print 'Which file?'
+    #usage: ./sys.argv[0] path_of_file(s) [--roi first,last ...] [--roi-file rois.txt] [--motors]
+    parser = argparse.ArgumentParser(description='Extract XAS spectra from h5 files using new ROIs.')
+    parser.add_argument('files', nargs='*', help='h5 files to process')
+    parser.add_argument('--motors', action='store_true', help='include the monochromator motors')
+    add_roi_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.files:
+        print('Which file?')
+        sys.exit(1)
+    new_rois = rois_from_arguments(args)
+    if not new_rois:
+        new_rois = [parse_roi(input('First and last channel of the new ROI? [min, max]\n' ))]
+
+    for name_file in args.files:
+        try:
+            process_hdf_file(name_file, new_rois, args.motors, args.prefix_cache)
+        except Exception as e:
+            print('Could not process %s: %s' %(name_file, e))
     
         
\ No newline at end of file
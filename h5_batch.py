@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Batch runner shared by the scripts that process all the h5 files of a folder.
+# 1) Sorts the files from the largest to the smallest, so that big maps do not end up last
+# 2) Spreads the files over a pool of processes (one file per process at a time)
+# 3) Catches the errors file by file: a broken file is reported, the others go on
+# 4) Prints a summary of the whole batch at the end
+# 5) Optionally skips the files already processed with the same parameters (see h5_manifest)
+
+import argparse
+import concurrent.futures
+import os
+import time
+import traceback
+
+import h5py
+
+from h5_io import set_threads
+from h5_manifest import load_manifest, params_key, record, save_manifest, source_key, up_to_date
+from h5_map_handling_v2 import iter_runs
+
+
+def batch_arguments(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of files processed in parallel (default: number of CPUs, 1 = no pool)')
+    return parser
+
+
+def _process_one(func, filename, out_path, kwargs):
+    start = time.time()
+    try:
+        outputs = func(filename, out_path, **kwargs)
+    except Exception:
+        return filename, False, time.time() - start, traceback.format_exc(), None
+    return filename, True, time.time() - start, None, outputs
+
+
+# threads left to each worker process for the decompression of the chunks (see h5_io.ChunkReader)
+def worker_threads(workers):
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _file_size(filename):
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def summary(results, elapsed):
+    done = [r for r in results if r[1]]
+    failed = [r for r in results if not r[1]]
+    print('\n\t-------------------------------------------------')
+    print('\tProcessed %d/%d files in %.1f s.' %(len(done), len(results), elapsed))
+    if done:
+        slowest = max(done, key=lambda r: r[2])
+        print('\tSlowest file: %s (%.1f s).' %(slowest[0], slowest[2]))
+    if failed:
+        print('\t⚠ %d file(s) could not be processed:' %len(failed))
+        for filename, ok, t, error, outputs in failed:
+            print('\t  - %s: %s' %(filename, error.strip().split('\n')[-1]))
+    print('\t-------------------------------------------------\n')
+
+
+# manifest entry of a product: one for each run when the runs are processed separately
+def _product(product, run):
+    return product if run is None else '%s:%s' %(product, run)
+
+
+def _source_key(filename):
+    try:
+        return source_key(filename)
+    except OSError:
+        return None
+
+
+# runs of a file, or [None] if it cannot be read (the error is then reported by func)
+def _runs(filename):
+    try:
+        with h5py.File(filename, 'r') as f:
+            return iter_runs(f) or [None]
+    except OSError:
+        return [None]
+
+
+# func is called as func(filename, out_path, **kwargs) for each file in file_list, and returns the list of
+# files it wrote (or None).
+# per_run=True: each run of a file is a separate unit of work, func(filename, out_path, run=run, **kwargs),
+# so that the runs of a multi-run file are processed in parallel too.
+# manifest: (product, version, parameters) to skip the files whose outputs are up to date (force=True: no skipping).
+# Returns a list of (filename, success, seconds, traceback or None, outputs), in order of completion
+# (filename is 'file [run]' for the runs of multi-run files).
+def run_batch(func, file_list, out_path, workers=None, label='File', manifest=None, force=False, per_run=False,
+              **kwargs):
+    file_list = sorted(file_list, key=_file_size, reverse=True)
+    units = [(filename, None) for filename in file_list]
+    names = {unit: unit[0] for unit in units}
+    if per_run:
+        units = []
+        for filename in file_list:
+            runs = _runs(filename)
+            for run in runs:
+                units.append((filename, run))
+                names[(filename, run)] = filename if len(runs) == 1 else '%s [%s]' %(filename, run)
+
+    if manifest is not None:
+        product, version, params = manifest
+        key = params_key(version, params)
+        done = load_manifest(out_path)
+        sources = {filename: _source_key(filename) for filename in file_list}
+        todo = [(filename, run) for filename, run in units
+                if force or not up_to_date(done, out_path, filename, _product(product, run), sources[filename], key)]
+        if len(todo) < len(units):
+            print('\t%d %s already processed with the same parameters: skipped (--force to process them again).'
+                  %(len(units) - len(todo), 'run(s)' if per_run else 'file(s)'))
+        units = todo
+        if not units:
+            return []
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(units)))
+
+    results = []
+    start = time.time()
+
+    def report(unit, result):
+        filename, run = unit
+        result = (names[unit],) + result[1:]
+        results.append(result)
+        name, ok, t, error, outputs = result
+        if ok:
+            if manifest is not None and sources[filename] is not None:
+                record(done, out_path, filename, _product(product, run), sources[filename], key, outputs)
+                save_manifest(out_path, done)
+            print('\n- - - - {0} {1}/{2} successfully processed ({3}, {4:.1f} s).\n'.format(
+                  label, len(results), len(units), name, t))
+        else:
+            print('\n- - - - ⚠ {0} {1}/{2} failed ({3}):\n{4}'.format(
+                  label, len(results), len(units), name, error))
+
+    def arguments(run):
+        return kwargs if run is None else dict(kwargs, run=run)
+
+    if workers == 1:
+        for filename, run in units:
+            report((filename, run), _process_one(func, filename, out_path, arguments(run)))
+    else:
+        print('\tProcessing %d %s with %d workers.\n' %(len(units), 'runs' if per_run else 'files', workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=set_threads,
+                                                    initargs=(worker_threads(workers),)) as pool:
+            futures = {pool.submit(_process_one, func, filename, out_path, arguments(run)): (filename, run)
+                       for filename, run in units}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    report(futures[future], future.result())
+                except Exception:
+                    # the worker process itself died (e.g. killed for lack of memory)
+                    report(futures[future], (None, False, 0.0, traceback.format_exc(), None))
+
+    summary(results, time.time() - start)
+    return results
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Small "sidecar" files saved next to the original h5 files, to avoid doing the same work twice.
+# Each sidecar keeps the size and modification time of its h5 file:
+# when the h5 file changes, the sidecar is ignored (and rewritten).
+
+import json
+import os
+
+
+def source_signature(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def sidecar_path(filename, suffix):
+    return filename + suffix
+
+
+def is_fresh(signature, filename):
+    try:
+        return signature == source_signature(filename)
+    except OSError:
+        return False
+
+
+def load_sidecar(filename, suffix):
+    try:
+        with open(sidecar_path(filename, suffix)) as sc:
+            content = json.load(sc)
+    except (OSError, ValueError):
+        return None
+    if not is_fresh(content.get('source'), filename):
+        return None
+    return content
+
+
+# The sidecar is written to a temporary file and then renamed, so that a reader never sees half a file.
+# If the folder of the h5 file is read only, nothing is saved.
+def save_sidecar(filename, suffix, content):
+    content = dict(content, source=source_signature(filename))
+    path = sidecar_path(filename, suffix)
+    tmp = path + '.%d.tmp' %os.getpid()
+    try:
+        with open(tmp, 'w') as sc:
+            json.dump(content, sc)
+        os.replace(tmp, path)
+    except OSError:
+        return False
+    return True
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Reading the h5 datasets without extra copies, when the storage allows it.
+# A dataset stored contiguous and uncompressed is a plain array at a fixed position of the file:
+# dataset_view gives it as a read-only np.memmap, so slicing, normalising and reshaping work directly
+# on the pages of the file (page cache) and only the pixels used are read.
+# Chunked datasets compressed with gzip (and shuffle) are read by ChunkReader: the compressed chunks are
+# taken as they are from the file and inflated by a pool of threads (zlib works outside the GIL, while
+# h5py decompresses one chunk at a time under its own lock), so one large file uses all the cores.
+# The same datasets are written by ChunkWriter: the chunks are shuffled and compressed by the threads and
+# stored as they are (direct chunk writes), giving a standard gzip dataset.
+# Other chunked, virtual or external datasets are read and written through h5py as usual.
+
+import collections
+import concurrent.futures
+import h5py
+import itertools
+import numpy as np
+import os
+import zlib
+
+# file drivers keeping the h5 file as a single plain file on disk
+MEMMAP_DRIVERS = ('sec2', 'stdio', 'windows')
+# filters ChunkReader and ChunkWriter can apply and undo by themselves
+DIRECT_FILTERS = (h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE)
+# threads decompressing the chunks (see set_threads)
+THREADS = os.cpu_count() or 1
+
+_pool = None
+
+
+def is_mappable(dset):
+    if dset.chunks is not None or dset.compression is not None or dset.is_virtual or dset.external:
+        return False
+    if dset.file.driver not in MEMMAP_DRIVERS:
+        return False
+    if dset.shape == () or dset.size == 0 or dset.dtype.kind not in 'biufc':
+        return False
+    # None when the data were never written (only the fill value)
+    return dset.id.get_offset() is not None
+
+
+# number of threads of the ChunkReaders of this process (e.g. the CPUs divided by the processes of a batch)
+def set_threads(threads):
+    global THREADS, _pool
+    THREADS = max(1, threads)
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+def _thread_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=THREADS)
+    return _pool
+
+
+# (code, parameters) of each filter, in the order they are applied when writing
+def _filters(dset):
+    plist = dset.id.get_create_plist()
+    return [plist.get_filter(i)[:3:2] for i in range(plist.get_nfilters())]
+
+
+# chunked dataset compressed with gzip (and shuffle) only
+def is_direct_chunked(dset):
+    if dset.chunks is None or dset.is_virtual or dset.external:
+        return False
+    if dset.shape == () or dset.size == 0 or dset.dtype.kind not in 'biufc':
+        return False
+    codes = [code for code, values in _filters(dset)]
+    return h5py.h5z.FILTER_DEFLATE in codes and all(code in DIRECT_FILTERS for code in codes)
+
+
+# create_dataset options giving the same filter pipeline as dset (gzip, with or without shuffle before it),
+# so that its compressed chunks can be stored as they are in the new dataset; None for other pipelines
+def gzip_options(dset):
+    if dset.chunks is None or dset.is_virtual or dset.external:
+        return None
+    filters = _filters(dset)
+    codes = [code for code, values in filters]
+    if codes not in ([h5py.h5z.FILTER_DEFLATE], [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_DEFLATE]):
+        return None
+    values = filters[-1][1]
+    return {'compression': 'gzip', 'compression_opts': values[0] if values else 6, 'shuffle': len(codes) == 2}
+
+
+# np.memmap of the dataset if possible, a ChunkReader for gzip datasets, otherwise the h5py dataset itself:
+# all of them can be sliced the same way
+def dataset_view(dset):
+    if is_mappable(dset):
+        return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype, offset=dset.id.get_offset(), shape=dset.shape)
+    if THREADS > 1 and is_direct_chunked(dset):
+        return ChunkReader(dset)
+    return dset
+
+
+# the whole dataset as an array (read-only np.memmap when possible, otherwise a copy)
+def read_array(dset):
+    view = dataset_view(dset)
+    if view is dset or isinstance(view, ChunkReader):
+        return view[...]
+    return view
+
+
+# bytes of a chunk as written by the shuffle filter (byte 0 of all the values, then byte 1, ...) -> values
+def _unshuffle(raw, itemsize):
+    if itemsize == 1:
+        return raw
+    planes = np.frombuffer(raw, np.uint8).reshape(itemsize, -1)
+    values = np.empty((planes.shape[1], itemsize), np.uint8)
+    # one byte plane at a time: faster than copying the transposed array
+    for i in range(itemsize):
+        values[:, i] = planes[i]
+    return values
+
+
+# undoes the filters of a chunk (in reverse order, skipping the ones of filter_mask)
+# and copies the part of the chunk selected to out
+def _decode_into(out, out_region, chunk_region, raw, filter_mask, filters, dtype, chunk_shape):
+    for i in reversed(range(len(filters))):
+        if filter_mask & (1 << i):
+            continue
+        if filters[i][0] == h5py.h5z.FILTER_DEFLATE:
+            raw = zlib.decompress(raw)
+        else:
+            raw = _unshuffle(raw, dtype.itemsize)
+    chunk = np.frombuffer(raw, dtype=dtype).reshape(chunk_shape)
+    out[out_region] = chunk[chunk_region]
+
+
+# (start, stop) of each axis for a key made of contiguous slices, None for any other key
+def _bounds(key, shape):
+    if key is Ellipsis:
+        key = ()
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > len(shape) or not all(isinstance(k, slice) and k.step in (None, 1) for k in key):
+        return None
+    key = key + (slice(None),)*(len(shape) - len(key))
+    bounds = [k.indices(n)[:2] for k, n in zip(key, shape)]
+    if any(stop <= start for start, stop in bounds):
+        return None
+    return bounds
+
+
+class ChunkReader:
+    """Gzip (+shuffle) chunked dataset read with direct chunk reads and decompressed by a pool of threads.
+
+    Sliced like the h5py dataset; selections that are not contiguous slices, or that fall in a single
+    chunk, are left to h5py (and to its chunk cache).
+    """
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.shape = dset.shape
+        self.dtype = dset.dtype
+        self.ndim = dset.ndim
+        self.chunks = dset.chunks
+        self.filters = _filters(dset)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        bounds = _bounds(key, self.shape)
+        if bounds is None:
+            return self.dset[key]
+        ranges = [range(start - start % c, stop, c) for (start, stop), c in zip(bounds, self.chunks)]
+        if np.prod([len(r) for r in ranges]) < 2:
+            return self.dset[key]
+
+        out = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+        pool = _thread_pool()
+        futures = []
+        # the compressed chunks are read here, one after the other (h5py lock), and inflated by the threads
+        for offset in itertools.product(*ranges):
+            out_region, chunk_region = [], []
+            for o, c, (start, stop) in zip(offset, self.chunks, bounds):
+                lo, hi = max(o, start), min(o + c, stop)
+                out_region.append(slice(lo - start, hi - start))
+                chunk_region.append(slice(lo - o, hi - o))
+            out_region, chunk_region = tuple(out_region), tuple(chunk_region)
+            try:
+                filter_mask, raw = self.dset.id.read_direct_chunk(offset)
+            except RuntimeError:
+                # chunk never written
+                out[out_region] = self.dset.fillvalue
+                continue
+            futures.append(pool.submit(_decode_into, out, out_region, chunk_region, raw, filter_mask,
+                                       self.filters, self.dtype, self.chunks))
+        for future in futures:
+            future.result()
+        return out
+
+
+# values -> bytes of a chunk as written by the shuffle filter (byte 0 of all the values, then byte 1, ...)
+def _shuffle(chunk):
+    itemsize = chunk.dtype.itemsize
+    values = chunk.view(np.uint8).reshape(-1, itemsize)
+    if itemsize == 1:
+        return values
+    planes = np.empty((itemsize, values.shape[0]), np.uint8)
+    for i in range(itemsize):
+        planes[i] = values[:, i]
+    return planes
+
+
+# applies the filters of the dataset to a whole chunk: the bytes to store
+def _encode(chunk, filters):
+    data = chunk
+    for code, values in filters:
+        if code == h5py.h5z.FILTER_DEFLATE:
+            data = zlib.compress(data, values[0] if values else 6)
+        else:
+            data = _shuffle(data)
+    return data
+
+
+class ChunkWriter:
+    """Writes hyperslabs of a dataset; gzip (+shuffle) chunks are compressed by a pool of threads.
+
+    writer[r0:r1] = block as with the h5py dataset (contiguous slices only), then close() (or a with block).
+    A chunk is compressed and stored as soon as all its values have been given; the chunks written only
+    in part are stored by close(), with the fill value in the rest. Each value must be written once.
+    Datasets with other filters, or a single thread, are written through h5py.
+    """
+
+    def __init__(self, dset):
+        self.dset = dset
+        self.direct = THREADS > 1 and is_direct_chunked(dset)
+        if self.direct:
+            self.shape = dset.shape
+            self.dtype = dset.dtype
+            self.chunks = dset.chunks
+            self.filters = _filters(dset)
+            self.pending = {}
+            self.running = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, tb):
+        if kind is None:
+            self.close()
+
+    # values of the chunk at offset inside the dataset (edge chunks are partly outside)
+    def _size(self, offset):
+        return int(np.prod([min(o + c, n) - o for o, c, n in zip(offset, self.chunks, self.shape)]))
+
+    def __setitem__(self, key, values):
+        if not self.direct:
+            self.dset[key] = values
+            return
+        bounds = _bounds(key, self.shape)
+        if bounds is None:
+            raise ValueError('ChunkWriter: only contiguous slices can be written (%r)' %(key,))
+        values = np.broadcast_to(values, [stop - start for start, stop in bounds])
+        ranges = [range(start - start % c, stop, c) for (start, stop), c in zip(bounds, self.chunks)]
+        for offset in itertools.product(*ranges):
+            values_region, chunk_region = [], []
+            for o, c, (start, stop) in zip(offset, self.chunks, bounds):
+                lo, hi = max(o, start), min(o + c, stop)
+                values_region.append(slice(lo - start, hi - start))
+                chunk_region.append(slice(lo - o, hi - o))
+            part = values[tuple(values_region)]
+            if offset not in self.pending and part.shape == self.chunks:
+                # the whole chunk at once (the common case)
+                self._submit(offset, np.array(part, dtype=self.dtype))
+                continue
+            if offset not in self.pending:
+                self.pending[offset] = [np.full(self.chunks, self.dset.fillvalue, dtype=self.dtype), 0]
+            chunk = self.pending[offset]
+            chunk[0][tuple(chunk_region)] = part
+            chunk[1] += part.size
+            if chunk[1] == self._size(offset):
+                del self.pending[offset]
+                self._submit(offset, chunk[0])
+
+    # the chunks are compressed by the threads and stored here, in this thread (h5py lock);
+    # at most two chunks per thread wait in memory
+    def _submit(self, offset, chunk):
+        self.running.append((offset, _thread_pool().submit(_encode, chunk, self.filters)))
+        while self.running and (len(self.running) > 2*THREADS or self.running[0][1].done()):
+            self._store()
+
+    def _store(self):
+        offset, future = self.running.popleft()
+        self.dset.id.write_direct_chunk(offset, future.result())
+
+    def close(self):
+        if not self.direct:
+            return
+        for offset, (chunk, count) in list(self.pending.items()):
+            self._submit(offset, chunk)
+        self.pending = {}
+        while self.running:
+            self._store()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Live reshaping of a map while it is being acquired (HDF5 SWMR: single writer, multiple readers).
+# 1) Opens the raw file in SWMR read mode, so that the acquisition can keep writing it
+# 2) Waits for the first line of the map, to know the length of the lines (see scan_geometry)
+# 3) Every few seconds, appends the lines completed since the previous check (rows, or columns for
+#    column-first maps) to growing datasets of the output file. The output is written in SWMR mode too:
+#    PyMCA or silx can open it while it grows.
+# 4) When the raw file stops growing for `idle` seconds (or with Ctrl+C), the map is cut as
+#    reshape-cut-rotate_v5 does (beam dumps), and the comments, beam mask and starting positions are added.
+# The raw file has to be written in SWMR mode by the acquisition (libver='latest').
+
+import datetime
+import h5py
+import math
+import numpy as np
+import os
+import time
+
+from h5_map_handling_v2 import (_quantise, check_bms, dataset_options, find_beam_dumps, get_name_and_date,
+                                reshape_scalar, scan_geometry, warning)
+
+PATH_SCALAR = "/Measurement/TransientScalarData"
+PATH_VECTOR = "/Measurement/TransientVectorData"
+POSITIONERS = "/Measurement/Positioners"
+I0_MONITOR = "BMS-T-Average"
+AcceptedList = ['BMS-3-Average','DIODE-Average','X','Y','Z']
+POLL = 2.0
+IDLE = 120.0
+
+
+# waits (up to `idle` seconds) for the acquisition to create the file and to start writing it in SWMR mode
+def _open_swmr(in_file, poll, idle):
+    start = time.time()
+    while True:
+        try:
+            return h5py.File(in_file, 'r', libver='latest', swmr=True)
+        except OSError:
+            if time.time() - start > idle:
+                raise
+            time.sleep(poll)
+
+
+# scan geometry of the pixels collected so far, or None until the slow motor has moved once (first line completed)
+def _first_line(ver, hor):
+    if len(ver) < 3:
+        return None
+    if not (np.diff(_quantise(ver)).any() and np.diff(_quantise(hor)).any()):
+        return None
+    return scan_geometry(ver, hor)
+
+
+def _shape(lines, col, rest, rotate):
+    if rotate:
+        return (col, lines) + rest
+    return (lines, col) + rest
+
+
+# the output grows one line at a time: unless the profile chooses the chunks, one chunk per line
+def _growing_options(profile, col, rest, rotate):
+    options = dataset_options(profile, _shape(col, col, rest, rotate))
+    if 'chunks' not in options:
+        options['chunks'] = _shape(1, col, rest, rotate)
+    return options
+
+
+class LiveMap:
+    def __init__(self, f, run, geometry, new_map, profile):
+        self.f = f
+        self.run = run
+        self.col = geometry['shape'][1]
+        self.rotate = geometry['move_ver_first']
+        self.lines = 0
+        self.fout = h5py.File(new_map, 'w', libver='latest')
+        try:
+            self._create(profile)
+        except BaseException:
+            self.fout.close()
+            raise
+
+    # the growing datasets, one for each source; then the output switches to SWMR mode
+    def _create(self, profile):
+        f, run = self.f, self.run
+        scalar, vector = f[run+PATH_SCALAR], f[run+PATH_VECTOR]
+        self.sources = {}
+        for name in scalar.keys():
+            if name in AcceptedList or name.endswith('LiveTime'):
+                self.sources[run+"/Motor_positions/"+name] = scalar[name]
+        for name in vector.keys():
+            self.sources[run+"/Detector_data/"+name] = vector[name]
+
+        self.dsets = {}
+        for dest, src in self.sources.items():
+            rest = src.shape[1:]
+            self.dsets[dest] = self.fout.create_dataset(dest, shape=_shape(0, self.col, rest, self.rotate),
+                                                        maxshape=_shape(None, self.col, rest, self.rotate),
+                                                        dtype=src.dtype,
+                                                        **_growing_options(profile, self.col, rest, self.rotate))
+        # from now on the output can be read while it grows (no new datasets can be added)
+        self.fout.swmr_mode = True
+
+    # pixels available in all the datasets
+    def pixels(self):
+        for src in self.sources.values():
+            src.refresh()
+        return min(src.shape[0] for src in self.sources.values())
+
+    # appends the lines completed since the previous call
+    def update(self):
+        lines = self.pixels() // self.col
+        if lines <= self.lines:
+            return 0
+        r0, r1, col = self.lines, lines, self.col
+        axis = 1 if self.rotate else 0
+        for dest, src in self.sources.items():
+            v = src[r0*col:r1*col]
+            dset = self.dsets[dest]
+            dset.resize(r1, axis=axis)
+            if v.ndim == 1:
+                v = reshape_scalar(v, r1-r0, col, self.rotate)
+            else:
+                v = v.reshape((r1-r0, col) + v.shape[1:])
+                if self.rotate:
+                    v = np.rot90(v, -1, axes=(1,0))
+            if self.rotate:
+                dset[:, r0:r1] = v
+            else:
+                dset[r0:r1] = v
+        self.fout.flush()
+        self.lines = lines
+        return r1 - r0
+
+    # final number of lines (cut), then the output is closed
+    def close(self, lines):
+        axis = 1 if self.rotate else 0
+        for dset in self.dsets.values():
+            dset.resize(lines, axis=axis)
+        self.lines = lines
+        self.fout.close()
+
+    # after an error: the output is closed as it is (closing it twice does nothing)
+    def release(self):
+        self.fout.close()
+
+
+def live_reshape(in_file, out_fold, poll=POLL, idle=IDLE, profile='default'):
+    f = _open_swmr(in_file, poll, idle)
+    try:
+        return _live_reshape(f, out_fold, poll, idle, profile)
+    finally:
+        f.close()
+
+
+def _live_reshape(f, out_fold, poll, idle, profile):
+    comment_line = 'This file has been generated with the script reshape-cut-rotate_V5 (live mode).\n'
+    comment_line += datetime.date.today().strftime('The original file was processed on: %d/%m/%Y.\n')
+
+    run, sample_name, date_acq = get_name_and_date(f)
+    new_map = os.path.join(out_fold, sample_name + date_acq.strftime('_%Y-%m-%d_%H-%M-%S'))
+    print("Sample_name: %s." %sample_name)
+    print('\tFollowing the acquisition (every %g s); it is considered finished after %g s without new pixels.'
+          %(poll, idle))
+    print('\tStop with Ctrl+C.')
+
+    scalar = f[run+PATH_SCALAR]
+    live = None
+    # the output is closed whatever happens while following the acquisition or cutting the map
+    try:
+        pixels = 0
+        last_growth = time.time()
+        try:
+            while True:
+                if live is None:
+                    scalar['X'].refresh()
+                    scalar['Y'].refresh()
+                    n = min(len(scalar['X']), len(scalar['Y']))
+                    geometry = _first_line(scalar['X'][0:n], scalar['Y'][0:n])
+                    if geometry is not None:
+                        if geometry['move_ver_first']:
+                            new_map += '_rot'
+                            comment_line += 'This map has been rotated.\n'
+                        new_map += '_live.h5'
+                        live = LiveMap(f, run, geometry, new_map, profile)
+                        print('\tLines of %d pixels: writing %s' %(live.col, new_map))
+                else:
+                    n = live.pixels()
+                    added = live.update()
+                    if added:
+                        print('\t%d lines ready.' %live.lines)
+                if n > pixels:
+                    pixels = n
+                    last_growth = time.time()
+                elif time.time() - last_growth > idle:
+                    break
+                time.sleep(poll)
+        except KeyboardInterrupt:
+            print('\n\tStopped: completing the map with the pixels collected so far.')
+
+        if live is None:
+            warning('The first line of the map was never completed:\nnothing to reshape.')
+            return None
+
+        live.update()
+        col = live.col
+        bms = scalar[I0_MONITOR]
+        bms.refresh()
+        bms = np.array(bms[...])
+        try:
+            beam_lost, valid_pixels, comment_line = check_bms(bms, comment_line)
+        except ValueError:
+            valid_pixels = 0
+        # as in reshape-cut-rotate_v5: incomplete lines and the pixels after the last beam dump are discarded
+        lines = min(live.lines, math.floor(valid_pixels/col))
+        if lines < live.lines or len(bms) > live.lines*col:
+            comment_line += 'The original map was cut to have a rectangular shape.\n'
+        live.close(lines)
+        print('\tFinal map: %d lines of %d pixels.' %(lines, col))
+    finally:
+        if live is not None:
+            live.release()
+
+    with_beam, segments = find_beam_dumps(bms)
+    with h5py.File(new_map, 'a') as fout:
+        fout.create_dataset("Comments", data=comment_line)
+        if not with_beam[0:lines*col].all():
+            fout.create_dataset(run+"/Motor_positions/Beam_mask", data=reshape_scalar(with_beam, lines, col, live.rotate))
+            fout.create_dataset(run+"/Motor_positions/Beam_segments", data=np.array(segments, dtype=int).reshape(-1, 2))
+        f.copy(f[run+POSITIONERS], fout, name=run+"/Starting_positions")
+    return [new_map]
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Manifest of the processed files, saved in the output folder (MANIFEST), to skip the work already done.
+# For each h5 file and each product (e.g. 'reshape') it keeps:
+# - the identity of the h5 file: size, modification time and a hash of the run keys and of the
+#   datasets' names, shapes and types (only the headers are read, not the data)
+# - a hash of the script version and of the parameters used (ROIs, BMS_MIN, PRECISION, ...)
+# - the output files written
+# A file is processed again only if it changed, if the version or the parameters of that product
+# changed, or if one of its outputs was deleted. Files for which nothing was written (no beam, no
+# HOR/VER movement, ...) are not recorded: they are tried again every time.
+
+import hashlib
+import h5py
+import json
+import os
+
+from h5_cache import source_signature
+
+MANIFEST = '.manifest.json'
+
+
+def add_manifest_arguments(parser):
+    parser.add_argument('--force', action='store_true',
+                        help='process all the files, also the ones already processed with the same parameters')
+    return parser
+
+
+def _hash(content):
+    text = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _header(name, obj, items):
+    if isinstance(obj, h5py.Dataset):
+        items.append((name, obj.shape, obj.dtype.str))
+    else:
+        items.append((name,))
+
+
+def source_key(filename):
+    key = source_signature(filename)
+    items = []
+    with h5py.File(filename, 'r') as f:
+        f.visititems(lambda name, obj: _header(name, obj, items))
+    key['header'] = _hash(items)
+    return key
+
+
+def params_key(version, params):
+    return _hash({'version': version, 'params': params})
+
+
+def load_manifest(out_path):
+    try:
+        with open(os.path.join(out_path, MANIFEST)) as mf:
+            return json.load(mf)
+    except (OSError, ValueError):
+        return {}
+
+
+# written to a temporary file and renamed, as the sidecars (see h5_cache)
+def save_manifest(out_path, manifest):
+    path = os.path.join(out_path, MANIFEST)
+    tmp = path + '.%d.tmp' %os.getpid()
+    try:
+        with open(tmp, 'w') as mf:
+            json.dump(manifest, mf, indent=1)
+        os.replace(tmp, path)
+    except OSError:
+        print('\t⚠ Could not save the manifest in %s.' %out_path)
+
+
+def up_to_date(manifest, out_path, filename, product, source, key):
+    entry = manifest.get(os.path.basename(filename), {})
+    done = entry.get('products', {}).get(product)
+    if entry.get('source') != source or done is None or done['key'] != key or not done['outputs']:
+        return False
+    return all(os.path.exists(os.path.join(out_path, output)) for output in done['outputs'])
+
+
+# outputs: the files written for this product (None or [] if the file was skipped by the script:
+# then the product is not recorded as done, and a previous record is dropped)
+def record(manifest, out_path, filename, product, source, key, outputs):
+    entry = manifest.setdefault(os.path.basename(filename), {})
+    if entry.get('source') != source:
+        entry['source'] = source
+        entry['products'] = {}
+    if not outputs:
+        entry.setdefault('products', {}).pop(product, None)
+        return
+    outputs = [os.path.relpath(output, out_path) for output in (outputs or [])]
+    entry.setdefault('products', {})[product] = {'key': key, 'outputs': outputs}
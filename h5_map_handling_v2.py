@@ -10,11 +10,34 @@ from datetime import datetime
 import h5py
 import math
 import numpy as np
+import os
+
+from h5_cache import load_sidecar, save_sidecar
+from h5_io import ChunkWriter, dataset_view, gzip_options, read_array
 
 
 BMS_MIN = 1e-4
 PRECISION = 10**5
 PATH_SCALAR = "/Measurement/TransientScalarData"
+GEOMETRY_SIDECAR = ".geometry.json"
+# to be increased whenever scan_geometry changes: the geometries cached by older versions are then ignored
+GEOMETRY_VERSION = 1
+
+# Compression and chunk layout of the reshaped spectra ("output profiles"):
+#   codec:  None (no compression), 'lzf' or 'gzip' (level 0-9)
+#   chunks: 'auto' (chosen by h5py), 'pixel' (one spectrum per chunk), 'row' (one row of the map),
+#           'tile' (TILE x TILE pixels)
+# 'default' is what has always been written (gzip + shuffle, h5py chunks), 'fast' favours writing speed.
+OUTPUT_PROFILES = {
+    'default': {'codec': 'gzip', 'level': 4,    'shuffle': True,  'chunks': 'auto'},
+    'fast':    {'codec': 'lzf',  'level': None, 'shuffle': True,  'chunks': 'row'},
+    'small':   {'codec': 'gzip', 'level': 9,    'shuffle': True,  'chunks': 'tile'},
+    'pixel':   {'codec': 'gzip', 'level': 4,    'shuffle': True,  'chunks': 'pixel'},
+    'none':    {'codec': None,   'level': None, 'shuffle': False, 'chunks': 'auto'},
+}
+CODECS = ('none', 'lzf', 'gzip')
+CHUNK_LAYOUTS = ('auto', 'pixel', 'row', 'tile')
+TILE = 16
 
 
 def _calculate_new_shape(shape_x, shape_y, valid_pixels, move_ver, new_name, comment):
@@ -42,40 +65,65 @@ def _calculate_new_shape(shape_x, shape_y, valid_pixels, move_ver, new_name, com
     
     return row, col, new_name, comment
 
-def check_bms(bms, comment_line):
+# Finds all the beam dumps in a single pass over the I0 signal.
+# Returns the mask of the pixels collected with beam and the (start, stop) boundaries of the segments with beam.
+# A dump followed by a refill in the middle of the map gives two (or more) segments.
+def find_beam_dumps(bms, bms_min=BMS_MIN):
+    with_beam = np.asarray(bms) >= bms_min
+    edges = np.flatnonzero(np.diff(with_beam.astype(np.int8))) + 1
+    bounds = np.concatenate(([0], edges, [len(with_beam)]))
+    segments = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if with_beam[start]]
+    return with_beam, segments
+
+def check_bms(bms, comment_line, bms_min=BMS_MIN):
     beam_lost = False
-            
-    if bms.min() > BMS_MIN:
+    with_beam, segments = find_beam_dumps(bms, bms_min)
+
+    if len(segments) == 0:
+        warning('No valid pixels, moving on.')
+        raise ValueError
+
+    if len(segments) == 1 and segments[0] == (0, len(bms)):
         print("\tNo beam dumps detected.")
         return (beam_lost, len(bms), comment_line)
         # if all the pixels are valid, it ends here.
-        
-    for last in range(len(bms)):
-        if bms[::-1][0] < BMS_MIN:
-            bms = bms[:len(bms)-1]
-            beam_lost = True
-        else:
-            print('\tLast useful I0 value = %f' %(bms[::-1][0]))
-            print('\tI0 at start = %f' %(bms[::1][0]))
-            break                    
-    print('  ⚠ ⚠ ⚠ Beam dump/drift: no beam in %d pixels.' %(last+1))
-    
-    if len(bms) == 0:
-        warning('No valid pixels, moving on.')
-        raise ValueError
-    
-    comment_line += 'The original map was cut until the last completed row/column.\n'
-    return(beam_lost, len(bms), comment_line)
+
+    # the pixels after the last refill are discarded
+    last = segments[-1][1]
+    if last < len(bms):
+        beam_lost = True
+        print('\tLast useful I0 value = %f' %(bms[last-1]))
+        print('\tI0 at start = %f' %(bms[0]))
+        print('  ⚠ ⚠ ⚠ Beam dump/drift: no beam in %d pixels.' %(len(bms)-last))
+        comment_line += 'The original map was cut until the last completed row/column.\n'
+
+    # the pixels without beam before the last refill are kept
+    gap_pixels = last - int(with_beam[:last].sum())
+    if gap_pixels:
+        print('  ⚠ Beam dump and refill during the map: no beam in %d pixels, kept in the map.' %gap_pixels)
+        comment_line += '%d pixels were collected without beam and kept in the map (see Beam_mask).\n' %gap_pixels
+
+    return(beam_lost, last, comment_line)
+
+# positions rounded to the PRECISION of the motors, as integers
+def _quantise(x):
+    return np.round(np.asarray(x, dtype=float)*PRECISION).astype(np.int64)
+
+# smallest movement of the motor and number of positions it went through (no sorting needed)
+def _axis_steps(q, moves):
+    step = np.abs(moves[moves != 0]).min()
+    shape = int(round((q.max() - q.min())/step)) + 1
+    return step, shape
 
 # gives the shape of the array by counting the numbers of different values    
 def count_steps(x):
-    step_x = np.round(np.diff(np.unique(x*PRECISION)).min())/PRECISION 
-    stx = np.round((x-x.min())/step_x).astype(int)  
-    shape_x = stx.max()+1
+    q = _quantise(x)
+    step_x, shape_x = _axis_steps(q, np.diff(q))
     return(shape_x)
 
+# read-only np.memmap for contiguous uncompressed datasets, a copy otherwise (see h5_io)
 def get_data(h5file, path):
-    info = np.array(h5file[path][...])
+    info = read_array(h5file[path])
     return info
 
 # flipping has to be implemented yet! An idea could be starting from the following
@@ -85,8 +133,39 @@ def _descending(j):
     else:
         pass
 
-def get_name_and_date(h5file):
-    key = list(h5file.keys())[0]
+# the runs (maps) of a file, in the order they were written: 'Run%Y%m%d %H%M%S <sample>'
+def iter_runs(h5file):
+    runs = []
+    for key in h5file.keys():
+        try:
+            datetime.strptime(key[:18], 'Run%Y%m%d %H%M%S')
+        except ValueError:
+            continue
+        runs.append(key)
+    return runs
+
+# added to the names of the outputs of a file with several runs (nothing if the file has one run only)
+def run_suffix(h5file, run):
+    runs = iter_runs(h5file)
+    if len(runs) < 2:
+        return ''
+    return '_run%d' %(runs.index(run) + 1)
+
+# Calls func(in_file, out_fold, run=run, **kwargs) for each run of in_file, one after the other.
+# Returns the list of all the files written.
+def for_each_run(func, in_file, out_fold, **kwargs):
+    with h5py.File(in_file, 'r') as f:
+        # files without dated runs: the first group, as before
+        runs = iter_runs(f) or list(f.keys())[:1]
+    outputs = []
+    for run in runs:
+        outputs += func(in_file, out_fold, run=run, **kwargs) or []
+    return outputs
+
+# run: key of the run (default: the first run of the file)
+def get_name_and_date(h5file, run=None):
+    runs = iter_runs(h5file)
+    key = run or (runs[0] if runs else list(h5file.keys())[0])
     date_str = 'Run%Y%m%d %H%M%S'
     # the first part of the string contains date and time of acquisition
     date_acq = datetime.strptime(key[:18], date_str)     
@@ -131,6 +210,72 @@ def read_positions(h5file, path):
         raise TypeError
     return x,y
 
+# Scan geometry from the X (VER) and Y (HOR) positions, in a single vectorised pass.
+# The fast axis is the motor moving at almost every pixel; a new line starts whenever the slow motor moves.
+# Returns a dictionary with:
+#   shape           [slow, fast] number of positions of the two motors
+#   steps           {'X': step, 'Y': step} in motor units
+#   fast_axis       'X' or 'Y'; move_ver_first is True when X (VER) is the fast axis (the map has to be rotated)
+#   line_directions +1/-1 for each line (direction of the fast motor), snake is True when they alternate
+#   lines, complete_lines   number of lines started and of lines with all the fast-axis positions
+def scan_geometry(ver, hor):
+    q = {'X': _quantise(ver), 'Y': _quantise(hor)}
+    moves = {'X': np.diff(q['X']), 'Y': np.diff(q['Y'])}
+    n_moves = {'X': np.count_nonzero(moves['X']), 'Y': np.count_nonzero(moves['Y'])}
+
+    if n_moves['X'] == 0 or n_moves['Y'] == 0:
+        warning('\tOnly one motor moved!\nIs this a linear scan?')
+        raise ValueError
+
+    fast_axis = 'X' if n_moves['X'] > n_moves['Y'] else 'Y'
+    slow_axis = 'Y' if fast_axis == 'X' else 'X'
+    # in a map the slow motor moves once per line: if it moves as often as the fast one, the map is somewhat broken.
+    if n_moves[slow_axis] > len(moves[slow_axis])//2:
+        warning('\tThe two axes moved together!\nIs this a diagonal linear scan?')
+        raise ValueError
+
+    new_line = moves[slow_axis] != 0
+    line_starts = np.concatenate(([0], np.flatnonzero(new_line) + 1))
+    line_ends = np.append(line_starts[1:], len(q[fast_axis]))
+    fast = q[fast_axis]
+    directions = np.sign(fast[line_ends - 1] - fast[line_starts]).astype(int)
+
+    step_fast, shape_fast = _axis_steps(fast, moves[fast_axis][~new_line])
+    step_slow, shape_slow = _axis_steps(q[slow_axis], moves[slow_axis])
+
+    moving = directions[directions != 0]
+    snake = len(moving) > 1 and bool(np.all(moving[1:] == -moving[:-1]))
+
+    return {'shape': [shape_slow, shape_fast],
+            'steps': {fast_axis: float(step_fast/PRECISION), slow_axis: float(step_slow/PRECISION)},
+            'fast_axis': fast_axis,
+            'move_ver_first': fast_axis == 'X',
+            'line_directions': directions.tolist(),
+            'snake': snake,
+            'lines': len(line_starts),
+            'complete_lines': int(np.count_nonzero(line_ends - line_starts == shape_fast))}
+
+# what the cached geometries depend on, besides the h5 file: the version of scan_geometry and the quantisation
+def _geometry_parameters():
+    return {'version': GEOMETRY_VERSION, 'precision': PRECISION}
+
+# Scan geometry of a run, cached in a sidecar next to the h5 file (GEOMETRY_SIDECAR):
+# the positions are read and analysed only the first time.
+# The sidecar is ignored if it was written with other parameters (see _geometry_parameters).
+def map_geometry(h5file, run):
+    parameters = _geometry_parameters()
+    cache = load_sidecar(h5file.filename, GEOMETRY_SIDECAR)
+    if cache is None or cache.get('parameters') != parameters:
+        cache = {'parameters': parameters, 'runs': {}}
+    if run in cache['runs']:
+        return cache['runs'][run]
+
+    ver, hor = read_positions(h5file, str(run+PATH_SCALAR))
+    geometry = scan_geometry(ver, hor)
+    cache['runs'][run] = geometry
+    save_sidecar(h5file.filename, GEOMETRY_SIDECAR, cache)
+    return geometry
+
 def warning(message, indent = 1, width = None, title = None):
     indent = 2
     lines = message.split('\n')
@@ -145,11 +290,167 @@ def warning(message, indent = 1, width = None, title = None):
     box += f'╚{"═" * (width + indent * 2)}╝'  # lower_border
     print(box)
 
-def _write_vector_to_h5(v, row, col, rotate, fout):
-    v = v[0:len]
-    v = v.reshape(row,col,v.shape[-1])                   
-    # the rotation of the map is done here:
+# a profile from OUTPUT_PROFILES, with some of its options changed (None = keep the profile's)
+def output_profile(name='default', codec=None, level=None, chunks=None):
+    profile = dict(OUTPUT_PROFILES[name], name=name)
+    if codec is not None:
+        profile['codec'] = None if codec == 'none' else codec
+        profile['shuffle'] = profile['codec'] is not None
+        if profile['codec'] == 'gzip' and profile['level'] is None:
+            profile['level'] = 4
+    if level is not None:
+        profile['level'] = level
+    if chunks is not None:
+        profile['chunks'] = chunks
+    return profile
+
+# keyword arguments of create_dataset for a (row, col, channels) dataset written with this profile.
+# band: map rows written at a time in a rotated (col, row, channels) dataset; its chunks span at most
+# a band along axis 1, so that the partial chunks kept by ChunkWriter stay within the memory budget.
+def dataset_options(profile, shape, band=None):
+    if isinstance(profile, str):
+        profile = OUTPUT_PROFILES[profile]
+    options = {}
+    if profile['codec'] is not None:
+        options['compression'] = profile['codec']
+        if profile['codec'] == 'gzip' and profile['level'] is not None:
+            options['compression_opts'] = profile['level']
+        options['shuffle'] = profile['shuffle']
+
+    shape = tuple(max(1, n) for n in shape)
+    if profile['chunks'] == 'pixel':
+        options['chunks'] = (1,)*(len(shape)-1) + shape[-1:]
+    elif profile['chunks'] == 'row':
+        options['chunks'] = (1,) + shape[1:]
+    elif profile['chunks'] == 'tile':
+        options['chunks'] = (min(TILE, shape[0]), min(TILE, shape[1])) + shape[2:]
+    if band is not None and 'chunks' in options and options['chunks'][1] > band:
+        options['chunks'] = options['chunks'][:1] + (max(1, band),) + options['chunks'][2:]
+    return options
+
+def profile_name(profile):
+    if isinstance(profile, str):
+        return profile
+    return '%s (codec=%s, level=%s, shuffle=%s, chunks=%s)' %(profile.get('name', 'custom'), profile['codec'],
+                                                             profile['level'], profile['shuffle'], profile['chunks'])
+
+# size in memory, size on disk and time needed to write a dataset
+def dataset_report(dset, seconds):
+    return (dset.name, dset.size * dset.dtype.itemsize, dset.id.get_storage_size(), seconds)
+
+# Writes (and prints) the compression ratio and write time of each dataset of an output file.
+def write_report(rows, profile, path):
+    lines = ['# output profile: %s' %profile_name(profile),
+             '# dataset, size (MB), stored (MB), compression ratio, write time (s), speed (MB/s)']
+    for name, raw, stored, seconds in rows:
+        ratio = raw / stored if stored else float('nan')
+        speed = raw / 1e6 / seconds if seconds else float('nan')
+        lines.append('%s, %.2f, %.2f, %.2f, %.2f, %.1f' %(name, raw/1e6, stored/1e6, ratio, seconds, speed))
+    with open(path, 'w') as report:
+        report.write('\n'.join(lines) + '\n')
+    print('\t' + '\n\t'.join(lines[1:]))
+
+# first row*col values of a 1D dataset as a (row, col) map, rotated like the spectra when needed
+def reshape_scalar(s, row, col, rotate):
+    s = s[0:row*col]
+    if s.shape[0] == row*col:
+        s = s.reshape(row, col)
+        if rotate:
+            s = np.rot90(s, -1, axes=(1,0))
+    return s
+
+def _rows_per_block(col, channels, itemsize, memory_budget):
+    # how many map rows fit in the memory budget (at least one, even if a single row is larger)
+    row_bytes = col * channels * itemsize
+    return max(1, int(memory_budget // row_bytes))
+
+# Chunks of the (row, col, channels) output holding exactly the pixels of one chunk of the flat source,
+# or None: the source chunks must span all the channels and be made of whole map lines (or a line of whole
+# chunks). Only for gzip profiles with automatic chunks: the output keeps the compression of the source.
+def passthrough_chunks(src, col, profile='default'):
+    if isinstance(profile, str):
+        profile = OUTPUT_PROFILES[profile]
+    if profile['codec'] != 'gzip' or profile['chunks'] != 'auto':
+        return None
+    if src.ndim != 2 or gzip_options(src) is None or src.chunks[1] != src.shape[1]:
+        return None
+    pixels = src.chunks[0]
+    if pixels % col == 0:
+        return (pixels // col, col, src.shape[1])
+    if col % pixels == 0:
+        return (1, pixels, src.shape[1])
+    return None
+
+# Reshaped copy of a map that is not rotated, made of the compressed chunks of src copied as they are
+# (no decompression and compression): the pixels keep their order, only the shape changes.
+def copy_vector_chunks(src, fout, dest, row, col, chunks):
+    dset = fout.create_dataset(dest, shape=(row, col, src.shape[1]), dtype=src.dtype, chunks=chunks,
+                               fillvalue=src.fillvalue, **gzip_options(src))
+    pixels = chunks[0] * chunks[1]
+    for start in range(0, row*col, pixels):
+        try:
+            filter_mask, raw = src.id.read_direct_chunk((start, 0))
+        except RuntimeError:
+            # chunk never written: fill value in the output too
+            continue
+        dset.id.write_direct_chunk((start // col, start % col, 0), raw, filter_mask)
+    return dset
+
+# map rows of the blocks of write_vector_to_h5: the rows that fit in the memory budget, rounded down
+# to whole chunks of the output along the axis of the map rows (axis 1 once rotated).
+# Each output chunk is then completed by a single block and written once, never read back.
+# If a single chunk is larger than the budget the blocks are not aligned: ChunkWriter keeps the partial chunks.
+def _block_rows(step, dset, rotate):
+    if dset.chunks is not None:
+        band = dset.chunks[1 if rotate else 0]
+        if band <= step:
+            step = step // band * band
+    return step
+
+# Streams a TransientVectorData dataset into its reshaped (and rotated) copy.
+# Only a block of whole map rows is kept in memory: rows are read as hyperslabs of the
+# flat pixel array and written to the matching slab of the output dataset.
+# When the map needs rotation, the source rows of a block become a band of columns of the output,
+# rotated in memory one block at a time: the map is never held whole, whatever its size.
+# Maps that are not rotated are copied chunk by chunk without recompression when the chunks allow it.
+def write_vector_to_h5(src, fout, dest, row, col, rotate, memory_budget, profile='default'):
+    chunks = None if rotate else passthrough_chunks(src, col, profile)
+    if chunks is not None:
+        return copy_vector_chunks(src, fout, dest, row, col, chunks)
+    channels = src.shape[-1]
     if rotate:
-       v = np.rot90(v, -1, axes=(1,0))
+        shape = (col, row, channels)
+    else:
+        shape = (row, col, channels)
+    # map rows that fit in memory_budget (all of them if None)
+    rows = row if memory_budget is None else _rows_per_block(col, channels, src.dtype.itemsize, memory_budget)
+    options = dataset_options(profile, shape, band=rows if rotate else None)
+    dset = fout.create_dataset(dest, shape=shape, dtype=src.dtype, **options)
+
+    step = _block_rows(rows, dset, rotate)
+    data = dataset_view(src)
+    # gzip chunks are compressed by several threads (see h5_io.ChunkWriter)
+    with ChunkWriter(dset) as out:
+        for r0 in range(0, row, step):
+            r1 = min(r0 + step, row)
+            v = data[r0*col:r1*col]
+            v = v.reshape(r1-r0, col, channels)
+            # the rotation of the map is done here, one block at a time:
+            if rotate:
+                out[:, r0:r1] = np.rot90(v, -1, axes=(1,0))
+            else:
+                out[r0:r1] = v
+    return dset
 
-    fout.create_dataset(key+"/Detector_data/"+vectorData, data=v, compression = "gzip", shuffle=True)
+# Writes a virtual dataset: no data is copied, each row of the (row, col, ...) output points
+# to the matching range of pixels of the source dataset. The source is referenced with a path
+# relative to the output file, so the two files can be moved together.
+# Rotated maps cannot be described this way: they need a real copy (write_vector_to_h5).
+def write_virtual_to_h5(src, fout, dest, row, col):
+    out_dir = os.path.dirname(os.path.abspath(fout.filename))
+    src_file = os.path.relpath(os.path.abspath(src.file.filename), out_dir)
+    source = h5py.VirtualSource(src_file, src.name, shape=src.shape, dtype=src.dtype)
+    layout = h5py.VirtualLayout(shape=(row, col) + src.shape[1:], dtype=src.dtype)
+    for r in range(row):
+        layout[r] = source[r*col:(r+1)*col]
+    return fout.create_virtual_dataset(dest, layout)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# One command for all the processing stages of the h5 files in the current folder.
+# The map stages run together on each file: the file is opened once, geometry and beam check are done once,
+# the scalars are read once and each spectra dataset is read once for all of them (see map_pipeline).
+#   reshape     cut, reshape and rotate (as reshape-cut-rotate_v5)
+#   normalise   cumulative spectrum normalised to LiveTime, i0 and pixels (as normalise_bms_LT_pixels)
+#   normalised  reshaped spectra normalised to LiveTime and i0
+#   maps        total counts and ROI maps
+#   orange      csv file for Orange (as convert_h5_to_orange)
+# and for the XANES scans:
+#   xanes       spectra with the Fe/Co and self-absorption ROIs, or the --roi given (as XANES_2ndROI_dt_good)
+# Each stage gets the files of its layout only: the maps have dated runs ('Run%Y%m%d %H%M%S ...'),
+# the XANES scans a 'triggers' dataset. The other h5 files are skipped.
+#
+# usage: python h5_treatment.py reshape normalise orange [-j 4] [--profile fast]
+#        python h5_treatment.py xanes --roi 600,644
+#
+# numpy, h5py and the modules of the stages are imported only once the arguments are read:
+# --help and wrong arguments answer at once.
+
+import argparse
+import glob
+import importlib
+import os
+
+MAP_STAGES = {'reshape': 'reshape', 'normalise': 'cumulative', 'normalised': 'normalised', 'maps': 'maps',
+              'orange': 'orange'}
+XANES_STAGES = ('xanes',)
+STAGES = tuple(MAP_STAGES) + XANES_STAGES
+EXT = 'h5'
+
+
+def arguments():
+    parser = argparse.ArgumentParser(description='Run one or more processing stages on the h5 files in the current folder.')
+    parser.add_argument('stages', nargs='+', choices=STAGES, metavar='STAGE',
+                        help='one or more of: %s' %', '.join(STAGES))
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of files processed in parallel (default: number of CPUs, 1 = no pool)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output folder of the map stages (default: pipeline); xanes writes to 2nd_Roi')
+    parser.add_argument('--profile', default='default',
+                        help='compression and chunk layout of the reshaped spectra: default, fast, small, pixel, none')
+    parser.add_argument('--roi', action='append', default=[], metavar='FIRST,LAST',
+                        help='first and last channel of a ROI (can be repeated)')
+    parser.add_argument('--roi-file', default=None,
+                        help='file with the ROIs: one "first, last" per line, or a json list')
+    return parser
+
+
+def _rois(parser, args):
+    roi_integration = importlib.import_module('roi_integration')
+    try:
+        rois = [roi_integration.parse_roi(roi) for roi in args.roi]
+        if args.roi_file:
+            rois += roi_integration.load_rois(args.roi_file)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    return rois
+
+
+# the h5 files of the current folder, sorted by layout: (maps, XANES scans)
+def files_by_layout():
+    h5py = importlib.import_module('h5py')
+    iter_runs = importlib.import_module('h5_map_handling_v2').iter_runs
+    maps, scans = [], []
+    for file_name in sorted(glob.glob('*.' + EXT)):
+        try:
+            with h5py.File(file_name, 'r') as f:
+                if iter_runs(f):
+                    maps.append(file_name)
+                elif 'triggers' in f:
+                    scans.append(file_name)
+                else:
+                    print('\t%s is neither a map nor a XANES scan: skipped.' %file_name)
+        except OSError as e:
+            print('\t%s cannot be read (%s): skipped.' %(file_name, e))
+    print('\tI found %d map(s) and %d XANES scan(s).' %(len(maps), len(scans)))
+    return maps, scans
+
+
+def main():
+    parser = arguments()
+    args = parser.parse_args()
+    rois = _rois(parser, args)
+    maps, scans = files_by_layout()
+
+    products = [MAP_STAGES[stage] for stage in args.stages if stage in MAP_STAGES]
+    if products:
+        map_pipeline = importlib.import_module('map_pipeline')
+        if args.profile not in map_pipeline.OUTPUT_PROFILES:
+            parser.error('unknown profile %r (choose from %s)' %(args.profile, ', '.join(sorted(map_pipeline.OUTPUT_PROFILES))))
+        out_path = args.output and os.path.join(args.output, '')
+        map_pipeline.run(products, rois, args.workers, args.profile, out_path, file_list=maps)
+
+    if 'xanes' in args.stages:
+        xanes = importlib.import_module('XANES_2ndROI_dt_good')
+        xanes.run(args.workers, rois or None, file_list=scans)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Watch mode: processes the h5 files of a folder as they are written, during the beamtime.
+# 1) Checks the folder every few seconds for new (or changed) h5 files
+# 2) Waits until a file is complete: same size and modification time as in the previous check,
+#    and not open for writing any more (HDF5 locks the files being written)
+# 3) Sends the file (or each of its runs) to a pool of processes, while the folder is still being watched
+# 4) Records the processed files in the manifest of the output folder, as run_batch does (see h5_manifest):
+#    the files processed by a batch run with the same parameters are skipped, and the other way round.
+#    Failed files are not recorded: they are tried again when they change or when the watcher restarts.
+# Stop it with Ctrl+C: the files being processed are completed first.
+
+import concurrent.futures
+import glob
+import h5py
+import os
+import signal
+import time
+
+from h5_batch import _process_one, _product, _runs, _source_key, worker_threads
+from h5_cache import source_signature
+from h5_io import set_threads
+from h5_manifest import load_manifest, params_key, record, save_manifest, up_to_date
+
+POLL = 2.0
+
+
+def add_watch_arguments(parser):
+    parser.add_argument('--watch', nargs='?', const='./', default=None, metavar='FOLDER',
+                        help='keep watching FOLDER (default: current folder) and process the new maps as they are closed')
+    parser.add_argument('--poll', type=float, default=POLL, help='seconds between two checks of the watched folder')
+    return parser
+
+
+# False while the acquisition is still writing the file (or the file is not a valid h5 file yet)
+def is_closed(filename):
+    try:
+        with h5py.File(filename, 'r'):
+            return True
+    except OSError:
+        return False
+
+
+# Ctrl+C stops the watcher only: the workers complete the file they are processing
+def _ignore_interrupt(threads):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_threads(threads)
+
+
+# unit: (filename, run, source key); the manifest is read again before saving it, to keep what
+# a batch run may have recorded meanwhile
+def _record(future, unit, out_path, product, key, label):
+    filename, run, source = unit
+    name = filename if run is None else '%s [%s]' %(filename, run)
+    try:
+        filename, ok, seconds, error, outputs = future.result()
+    except Exception as e:
+        # the worker process itself died (e.g. killed for lack of memory)
+        ok, seconds, error = False, 0.0, '%s: %s' %(type(e).__name__, e)
+    if ok:
+        print('- - - - {0} successfully processed ({1}, {2:.1f} s).'.format(label, name, seconds))
+        if source is not None:
+            done = load_manifest(out_path)
+            record(done, out_path, filename, _product(product, run), source, key, outputs)
+            save_manifest(out_path, done)
+    else:
+        print('- - - - ⚠ {0} failed ({1}):\n{2}'.format(label, name, error))
+
+
+# func is called as func(filename, out_path, **kwargs) for each new file, as in run_batch
+# (per_run=True: once for each run, with run=run).
+# manifest: (product, version, parameters), the same as the batch run of the script; by default
+# the name of func and the keyword arguments.
+def watch(func, in_path, out_path, workers=None, label='File', poll=POLL, ext='h5', manifest=None, per_run=False,
+          **kwargs):
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if manifest is None:
+        manifest = (func.__name__, None, kwargs)
+    product, version, params = manifest
+    key = params_key(version, params)
+
+    # signature of each file at the previous check: a file is ready when it has not changed since
+    previous = {}
+    # files already checked (up to date, processed or failed) with their signature: not checked again unless they change
+    checked = {}
+    running = {}
+    processed = 0
+    print('\tWatching %s for new .%s files (every %g s, %d workers). Stop with Ctrl+C.\n'
+          %(in_path, ext, poll, workers))
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_ignore_interrupt,
+                                               initargs=(worker_threads(workers),))
+    try:
+        while True:
+            queued = {filename for filename, run, source in running.values()}
+            for filename in sorted(glob.glob(os.path.join(in_path, '*.' + ext))):
+                name = os.path.basename(filename)
+                try:
+                    signature = source_signature(filename)
+                except OSError:
+                    continue
+                if checked.get(filename) == signature or filename in queued:
+                    continue
+                if previous.get(filename) != signature:
+                    previous[filename] = signature
+                    continue
+                if not is_closed(filename):
+                    continue
+                checked[filename] = signature
+                source = _source_key(filename)
+                done = load_manifest(out_path)
+                runs = _runs(filename) if per_run else [None]
+                todo = [run for run in runs if source is None
+                        or not up_to_date(done, out_path, filename, _product(product, run), source, key)]
+                if not todo:
+                    continue
+                print('- - - - New %s: %s' %(label.lower(), name))
+                for run in todo:
+                    future = pool.submit(_process_one, func, filename, out_path,
+                                         kwargs if run is None else dict(kwargs, run=run))
+                    running[future] = (filename, run, source)
+
+            finished, _ = concurrent.futures.wait(running, timeout=poll)
+            for future in finished:
+                _record(future, running.pop(future), out_path, product, key, label)
+                processed += 1
+            if not finished and not running:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        print('\n\tStopping: waiting for %d file(s) being processed.' %len(running))
+        for future in concurrent.futures.as_completed(running):
+            # files interrupted with the workers are not recorded: they are processed at the next start
+            if future.exception() is None:
+                _record(future, running[future], out_path, product, key, label)
+                processed += 1
+    finally:
+        pool.shutdown(wait=True)
+    print('\tProcessed %d files while watching.' %processed)
@@ -14,6 +14,11 @@ import numpy as np
 import os
 import sys
 
+from h5_io import ChunkWriter
+from h5_map_handling_v2 import copy_vector_chunks, dataset_options, iter_runs, passthrough_chunks, run_suffix, write_virtual_to_h5
+from h5_map_handling_v2 import check_bms as _check_bms
+from h5_map_handling_v2 import count_steps as _count_steps
+
 BMS_MIN = 1e-2
 PRECISION = 5
 EXT = "h5"
@@ -23,47 +28,33 @@ NEW_FOLDER = "/test_cut_min/"
 NEWNAME_APP = "_cut.h5"
 
 
+# same check as h5_map_handling_v2, with the BMS_MIN of this script and without the comments
 def check_bms(bms):
-    beam_lost = False
-            
-    if bms.min() > BMS_MIN:
-        print("No beam dumps detected.")
-        return (beam_lost, len(bms))
-        # if all the pixels are valid, it ends here.
-        
-    for last in range(len(bms)):
-        if bms[::-1][0] < BMS_MIN:
-            bms = bms[:len(bms)-1]
-                
-        else:
-            break                    
-    print('No beam in '+ str(last) + ' pixels.')
-    return(beam_lost, len(bms))
+    try:
+        beam_lost, last, comment_line = _check_bms(bms, '', BMS_MIN)
+    except ValueError:
+        return (True, 0)
+    return(beam_lost, last)
     
     
 def count_steps(x,y):
-    # extracts the map size from the unique positions of X e Y
-    step_x = np.round(np.diff(np.unique(x*10**PRECISION)).min())/10**PRECISION
-    step_y = np.round(np.diff(np.unique(y*10**PRECISION)).min())/10**PRECISION
-    
-    stx = np.round((x-x.min())/step_x).astype(int)
-    sty = np.round((y-y.min())/step_y).astype(int)
-    
-    shape_x = stx.max()+1
-    shape_y = sty.max()+1
-    
-    return(shape_x,shape_y)
+    # extracts the map size from the steps of X e Y
+    return(_count_steps(x), _count_steps(y))
      
 
-def cut_reshape(in_file, out_fold):
+# virtual=True writes HDF5 virtual datasets pointing to in_file instead of copying the spectra
+# profile: compression and chunks of the spectra (see OUTPUT_PROFILES in h5_map_handling_v2)
+def cut_reshape(in_file, out_fold, virtual=False, profile='default'):
     dest_path = out_fold
-    new_map = os.path.join( dest_path, in_file.split('.')[0] + NEWNAME_APP)
+    written = []
     
     with h5py.File(in_file, 'r') as f:
     
-        move_hor = False
-        for run in f.keys():
+        # each run is a separate map, written to its own file (_run1, _run2, ... if there are several)
+        for run in iter_runs(f) or list(f.keys())[:1]:
             print ("Run: %s" %run)
+            new_map = os.path.join( dest_path, in_file.split('.')[0] + run_suffix(f, run) + NEWNAME_APP)
+            move_hor = False
             
             x = f[run+PATH_SCALAR+"/X"][...]
             y = f[run+PATH_SCALAR+"/Y"][...]
@@ -81,20 +72,20 @@ def cut_reshape(in_file, out_fold):
  
             if move_hor:
                 col = shape_y
-                row = np.round(valid_pixels/shape_y)
+                row = int(np.round(valid_pixels/shape_y))
                 
             else:
                 row = shape_x
-                col = np.round(valid_pixels/shape_x)
+                col = int(np.round(valid_pixels/shape_x))
                     
             if valid_pixels < shape_x*shape_y:
                 print('Valid pixels =', valid_pixels)
                 print('Original map =', shape_x*shape_y)
                 
                 if move_hor:
-                    row = valid_pixels/shape_y
+                    row = valid_pixels//shape_y
                 else:
-                    col = valid_pixels/shape_x
+                    col = valid_pixels//shape_x
                     
             if beam_lost:
                 print('Original size:', shape_x, shape_y)
@@ -102,7 +93,7 @@ def cut_reshape(in_file, out_fold):
             
             if (row*col==shape_x*shape_y):
                 print('This map is ok! Moving on!\n')
-                break
+                continue
                 
             with h5py.File(new_map, 'w') as fout:
                 total_point = row * col
@@ -111,17 +102,35 @@ def cut_reshape(in_file, out_fold):
                 print('\n--> Cutting and reshaping TransientVectorData:')
                 for vectorData in f[run+PATH_VECTOR].keys():
                     print (vectorData)
+                    if virtual:
+                        write_virtual_to_h5(f[run+PATH_VECTOR+"/"+vectorData], fout, run+PATH_VECTOR+"/"+vectorData, int(row), int(col))
+                        continue
+                    # compressed chunks copied as they are, when they are made of whole lines of the map
+                    chunks = passthrough_chunks(f[run+PATH_VECTOR+"/"+vectorData], col, profile)
+                    if chunks is not None:
+                        copy_vector_chunks(f[run+PATH_VECTOR+"/"+vectorData], fout, run+PATH_VECTOR+"/"+vectorData, row, col, chunks)
+                        continue
                     v = f[run+PATH_VECTOR+"/"+vectorData][...]
                     v = v[0:total_point]
                     v = v.reshape((row,col,v.shape[-1]))
                     # print("New shape: ",v.shape)
-                    fout.create_dataset(run+PATH_VECTOR+"/"+vectorData, data=v, compression = "gzip", shuffle=True)
+                    dset = fout.create_dataset(run+PATH_VECTOR+"/"+vectorData, shape=v.shape, dtype=v.dtype,
+                                               **dataset_options(profile, v.shape))
+                    # gzip chunks compressed by several threads
+                    with ChunkWriter(dset) as out:
+                        out[...] = v
                 print('\n--> Done! Now cutting and reshaping TransientScalarData:')
                 
                 for scalarData in f[run+PATH_SCALAR].keys():
                     print(scalarData)
+                    if f[run+PATH_SCALAR+"/"+scalarData].shape[0] == total_point:
+                        # nothing to cut: copied by HDF5
+                        f.copy(f[run+PATH_SCALAR+"/"+scalarData], fout, name=run+PATH_SCALAR+"/"+scalarData)
+                        continue
                     s = f[run+PATH_SCALAR+"/"+scalarData][...]
                     s = s[0:total_point]
                     #print("New shape: ",s.shape)
                     fout.create_dataset(run+PATH_SCALAR+"/"+scalarData, data=s)
-  
+            written.append(new_map)
+
+    return written
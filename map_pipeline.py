@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# One pass over the XRF maps for all the derived products.
+# Each TransientVectorData dataset is read (and decompressed) once, in blocks of map rows,
+# and every block is handed to the products selected:
+#   reshape     reshaped (and rotated/cut) map, as reshape-cut-rotate_v5    -> <sample>_<date>.h5, Detector_data
+#   normalised  reshaped map normalised to LiveTime and i0                  -> same file, Normalised_data
+#   cumulative  cumulative spectrum normalised to LiveTime, i0 and pixels  -> <sample>_cumulative_norm.txt
+#   maps        total counts and ROI maps of each detector element          -> same file, Maps
+#   orange      csv file for Orange, as convert_h5_to_orange                -> <file>.csv
+#
+# usage: python map_pipeline.py --products reshape cumulative orange [--roi 600,644] [-j 8]
+
+import datetime
+import glob
+import h5py
+import math
+import numpy as np
+import os
+
+from convert_h5_to_orange import BMS_channel, CHANNELS, CSV_TITLE, csv_block
+from deadtime import deadtime_comments, map_deadtime, write_deadtime_maps
+from h5_batch import batch_arguments, run_batch
+from h5_io import ChunkWriter, dataset_view
+from h5_map_handling_v2 import (OUTPUT_PROFILES, _rows_per_block, check_bms, dataset_options, find_beam_dumps, for_each_run,
+                                get_name_and_date, map_geometry, reshape_scalar, run_suffix, warning)
+from h5_watch import add_watch_arguments, watch
+from normalise_bms_LT_pixels import DETECTOR_ELEMENTS, normalise_block, read_livetime, write_cumulative_txt
+from roi_integration import add_roi_arguments, integrate_rois, roi_name, rois_from_arguments
+
+EXT = "h5"
+PATH_SCALAR = "/Measurement/TransientScalarData"
+PATH_VECTOR = "/Measurement/TransientVectorData"
+POSITIONERS = "/Measurement/Positioners"
+NEW_FOLDER = "/pipeline/"
+I0_MONITOR = "/BMS-T-Average"
+NORM_MONITOR = "/BMS-3-Average"
+MEMORY_BUDGET = 256 * 1024**2
+PRODUCTS = ('reshape', 'normalised', 'cumulative', 'maps', 'orange')
+AcceptedList = ['BMS-3-Average','DIODE-Average','X','Y','Z']
+
+
+# Everything the products need to know about the map, read once.
+class MapLayout:
+    def __init__(self, f, run, row, col, rotate, comment_line):
+        self.f = f
+        self.run = run
+        self.row = row
+        self.col = col
+        self.rotate = rotate
+        self.final_points = row * col
+        self.comment_line = comment_line
+        self.pixels = len(f[run+PATH_SCALAR+"/X"])
+        self.elements = {}
+        for spectra_name, livetime_name in sum(DETECTOR_ELEMENTS.values(), []):
+            if spectra_name in f[run+PATH_VECTOR]:
+                self.elements[spectra_name] = livetime_name
+        self.scalars = {}
+        self._livetime = {}
+
+    # the scalars (positions, i0, LiveTime) are read only if a product needs them, and only once
+    def scalar(self, name):
+        if name not in self.scalars:
+            self.scalars[name] = np.array(self.f[self.run+PATH_SCALAR+"/"+name][...])
+        return self.scalars[name]
+
+    def i0(self):
+        return self.scalar(NORM_MONITOR.strip('/')).reshape(-1)
+
+    def livetime(self, spectra_name):
+        if spectra_name not in self._livetime:
+            self._livetime[spectra_name] = read_livetime(self.f, self.run, self.elements[spectra_name])
+        return self._livetime[spectra_name]
+
+    # output shape of a reshaped dataset
+    def shape(self, channels):
+        if self.rotate:
+            return (self.col, self.row, channels)
+        return (self.row, self.col, channels)
+
+    # create_dataset options of a reshaped dataset written by blocks of `rows` map rows
+    def options(self, profile, channels, rows):
+        return dataset_options(profile, self.shape(channels), band=rows if self.rotate else None)
+
+    # writes the rows of the map contained in the block of pixels starting at `start` (a multiple of col)
+    def write_rows(self, dset, start, block):
+        r0 = start // self.col
+        r1 = min(self.row, r0 + len(block) // self.col)
+        if r1 <= r0:
+            return
+        v = block[0:(r1-r0)*self.col].reshape(r1-r0, self.col, block.shape[-1])
+        if self.rotate:
+            dset[:, r0:r1] = np.rot90(v, -1, axes=(1,0))
+        else:
+            dset[r0:r1] = v
+
+
+# Products: each one gets the blocks of the datasets it wants(), and writes its output in close().
+# If the processing fails, discard() is called instead: what was kept is dropped, the files are released.
+class Reshape:
+    def __init__(self, layout, fout, profile):
+        self.layout, self.fout, self.profile = layout, fout, profile
+        self.writers = {}
+
+    def wants(self, name):
+        return True
+
+    def feed(self, name, start, block):
+        if name not in self.writers:
+            shape = self.layout.shape(block.shape[-1])
+            dset = self.fout.create_dataset(self.layout.run+"/Detector_data/"+name, shape=shape, dtype=block.dtype,
+                                            **self.layout.options(self.profile, shape[-1], len(block) // self.layout.col))
+            self.writers[name] = ChunkWriter(dset)
+        self.layout.write_rows(self.writers[name], start, block)
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+    def discard(self):
+        self.writers = {}
+
+
+class Normalised(Reshape):
+    def wants(self, name):
+        return name in self.layout.elements
+
+    def feed(self, name, start, block):
+        stop = start + len(block)
+        block = normalise_block(block, self.layout.livetime(name)[start:stop], self.layout.i0()[start:stop])
+        if name not in self.writers:
+            shape = self.layout.shape(block.shape[-1])
+            dset = self.fout.create_dataset(self.layout.run+"/Normalised_data/"+name, shape=shape, dtype=np.float32,
+                                            **self.layout.options(self.profile, shape[-1], len(block) // self.layout.col))
+            self.writers[name] = ChunkWriter(dset)
+        self.layout.write_rows(self.writers[name], start, block.astype(np.float32))
+
+
+class Cumulative:
+    def __init__(self, layout, txt_name):
+        self.layout, self.txt_name = layout, txt_name
+        self.norm_spec = None
+
+    def wants(self, name):
+        return name in self.layout.elements
+
+    def feed(self, name, start, block):
+        stop = start + len(block)
+        block = normalise_block(block, self.layout.livetime(name)[start:stop], self.layout.i0()[start:stop])
+        if self.norm_spec is None:
+            self.norm_spec = np.zeros(block.shape[-1])
+        self.norm_spec += block.sum(axis=0)
+
+    def close(self):
+        if self.norm_spec is not None:
+            comment_line = ''.join(['#' + line + '\n' for line in self.layout.comment_line.splitlines()])
+            write_cumulative_txt(self.txt_name, self.norm_spec / self.layout.pixels, comment_line)
+
+    def discard(self):
+        self.norm_spec = None
+
+
+# total counts and ROI integrals of each pixel, reshaped like the map
+class CountMaps:
+    def __init__(self, layout, fout, rois):
+        self.layout, self.fout, self.rois = layout, fout, rois
+        self.maps = {}
+
+    def wants(self, name):
+        return name in self.layout.elements
+
+    def feed(self, name, start, block):
+        if name not in self.maps:
+            self.maps[name] = np.zeros((self.layout.pixels, 1 + len(self.rois)))
+        stop = start + len(block)
+        self.maps[name][start:stop, 0] = block.sum(axis=-1)
+        if self.rois:
+            self.maps[name][start:stop, 1:] = integrate_rois(block, self.rois)
+
+    def close(self):
+        layout = self.layout
+        for name, values in self.maps.items():
+            group = layout.run+"/Maps/"+name+"/"
+            self.fout.create_dataset(group+"total_counts", data=reshape_scalar(values[:, 0], layout.row, layout.col, layout.rotate))
+            for i, roi in enumerate(self.rois):
+                self.fout.create_dataset(group+"roi_"+roi_name(roi),
+                                         data=reshape_scalar(values[:, 1+i], layout.row, layout.col, layout.rotate))
+
+    def discard(self):
+        self.maps = {}
+
+
+# only the spectra of the Bruker detector are exported
+class Orange:
+    SPECTRA = "SDD#1-Spectra"
+
+    def __init__(self, layout, csv_name):
+        self.layout = layout
+        f, run = layout.f, layout.run
+        self.x = layout.scalar("X")
+        self.y = layout.scalar("Y")
+        self.bms = f[run+PATH_VECTOR+"/"+BMS_channel]
+        self.csv_name = csv_name
+        self.txt = open(csv_name, 'w')
+        self.txt.write(CSV_TITLE)
+
+    def wants(self, name):
+        return name == self.SPECTRA
+
+    def feed(self, name, start, block):
+        stop = start + len(block)
+        self.txt.write(csv_block(self.x[start:stop], self.y[start:stop], self.bms[start:stop].mean(axis=1),
+                                 block[:, 0:CHANNELS]))
+
+    def close(self):
+        self.txt.close()
+
+    def discard(self):
+        self.txt.close()
+
+
+# run: key of the run; by default all the runs of the file, one after the other.
+# Returns the list of the files written (None if the run was skipped).
+def process_map(in_file, out_fold, products=PRODUCTS, rois=(), memory_budget=MEMORY_BUDGET, profile='default', run=None):
+    if run is None:
+        return for_each_run(process_map, in_file, out_fold, products=products, rois=rois, memory_budget=memory_budget,
+                            profile=profile)
+
+    f = h5py.File(in_file, 'r')
+    try:
+        return _process_run(f, in_file, out_fold, products, rois, memory_budget, profile, run)
+    finally:
+        f.close()
+
+
+def _process_run(f, in_file, out_fold, products, rois, memory_budget, profile, run):
+    comment_line = 'This file has been generated with the script map_pipeline.\n'
+    comment_line += datetime.date.today().strftime('The original file was processed on: %d/%m/%Y.\n')
+
+    run, sample_name, date_acq = get_name_and_date(f, run)
+    suffix = run_suffix(f, run)
+    new_map = os.path.join(out_fold, sample_name + date_acq.strftime('_%Y-%m-%d_%H-%M-%S'))
+    print("Sample_name: %s." %sample_name)
+
+    try:
+        geometry = map_geometry(f, run)
+    except KeyError:
+        warning('HOR/VER movement not found! Moving on!')
+        return None
+    except (TypeError, ValueError):
+        return None
+
+    rotate = geometry['move_ver_first']
+    if geometry['snake']:
+        comment_line += 'Snake scan: every other line was collected backwards and has not been flipped.\n'
+    shape_x, shape_y = geometry['shape']
+
+    bms = np.array(f[run+PATH_SCALAR+I0_MONITOR][...])
+    try:
+        beam_lost, valid_pixels, comment_line = check_bms(bms, comment_line)
+    except ValueError:
+        # no pixel with beam (check_bms has said so): nothing to process
+        return None
+    with_beam, segments = find_beam_dumps(bms)
+
+    # same shape as reshape-cut-rotate_v5: one row for each complete line of the fast motor
+    col = shape_y
+    row = math.floor(valid_pixels/shape_y)
+    if rotate:
+        new_map += '_rot'
+        comment_line += 'This map has been rotated.\n'
+    if valid_pixels < shape_x*shape_y:
+        if not beam_lost:
+            comment_line += 'Incomplete acquisition found. The original map was cut to have a rectangular shape.\n'
+        new_map += '_cut'
+    else:
+        comment_line += 'This map was not cut. Only reshaping has been done.\n'
+    print('\tNew map shape: (%d, %d)' %(row, col))
+
+    # deadtime maps of the reshaped file, as reshape-cut-rotate_v5
+    deadtimes = {}
+    if 'reshape' in products:
+        deadtimes = {element: (deadtime[0:row*col], reference)
+                     for element, (deadtime, reference) in map_deadtime(f, run).items()}
+        comment_line += deadtime_comments(deadtimes)
+
+    layout = MapLayout(f, run, row, col, rotate, comment_line)
+    layout.scalars[I0_MONITOR.strip('/')] = bms
+    if 'orange' in products and Orange.SPECTRA not in f[run+PATH_VECTOR]:
+        print('\tNo %s in this map: no csv file for Orange.' %Orange.SPECTRA)
+        products = [product for product in products if product != 'orange']
+
+    sinks = []
+    fout = None
+    try:
+        if set(products) & {'reshape', 'normalised', 'maps'}:
+            fout = h5py.File(new_map + '.h5', 'w', rdcc_nbytes=memory_budget)
+            fout.create_dataset("Comments", data=comment_line)
+        if 'reshape' in products:
+            sinks.append(Reshape(layout, fout, profile))
+        if 'normalised' in products:
+            sinks.append(Normalised(layout, fout, profile))
+        if 'cumulative' in products:
+            sinks.append(Cumulative(layout, os.path.join(out_fold, sample_name + suffix + '_cumulative_norm.txt')))
+        if 'maps' in products:
+            sinks.append(CountMaps(layout, fout, list(rois)))
+        if 'orange' in products:
+            sinks.append(Orange(layout, os.path.join(out_fold, os.path.basename(in_file).split('.')[0] + suffix + '.csv')))
+
+        # the single read of the spectra: blocks of whole map rows, given to all the products that want them
+        for vectorData in f[run+PATH_VECTOR].keys():
+            readers = [sink for sink in sinks if sink.wants(vectorData)]
+            if not readers:
+                continue
+            src = dataset_view(f[run+PATH_VECTOR+"/"+vectorData])
+            step = col * _rows_per_block(col, src.shape[-1], src.dtype.itemsize, memory_budget)
+            for start in range(0, src.shape[0], step):
+                block = src[start:start+step]
+                for sink in readers:
+                    sink.feed(vectorData, start, block)
+
+        for sink in sinks:
+            sink.close()
+
+        if 'reshape' in products:
+            for scalarData in f[run+PATH_SCALAR].keys():
+                if scalarData in AcceptedList or scalarData.endswith('LiveTime'):
+                    s = layout.scalar(scalarData)
+                    fout.create_dataset(run+"/Motor_positions/"+scalarData, data=reshape_scalar(s, row, col, rotate))
+            if not with_beam[0:row*col].all():
+                fout.create_dataset(run+"/Motor_positions/Beam_mask", data=reshape_scalar(with_beam, row, col, rotate))
+                fout.create_dataset(run+"/Motor_positions/Beam_segments", data=np.array(segments, dtype=int).reshape(-1, 2))
+            write_deadtime_maps(fout, run, deadtimes, lambda deadtime: reshape_scalar(deadtime, row, col, rotate))
+            f.copy(f[run+POSITIONERS], fout, name=run+"/Starting_positions")
+    except BaseException:
+        for sink in sinks:
+            sink.discard()
+        raise
+    finally:
+        if fout is not None:
+            fout.close()
+
+    outputs = [] if fout is None else [new_map + '.h5']
+    for sink in sinks:
+        if isinstance(sink, Cumulative) and sink.norm_spec is not None:
+            outputs.append(sink.txt_name)
+        elif isinstance(sink, Orange):
+            outputs.append(sink.csv_name)
+    return outputs
+
+####################################################################
+
+# file_list: the maps to process (default: all the h5 files in the current folder)
+def run(products=PRODUCTS, rois=(), workers=None, profile='default', out_path=None, file_list=None):
+    print('\n\t---     Processing your XRF maps: %s     ---\n' %', '.join(products))
+
+    in_path = './'
+    out_path = out_path or in_path + NEW_FOLDER
+    if file_list is None:
+        file_list = [filename[2:] for filename in glob.glob('{0}/*'.format(in_path)+EXT)]
+        print('\tI found '+str(len(file_list))+' files matching the extension '+EXT+'.')
+
+    if len(file_list) == 0:
+        print("\t⚠ Can't do much with 0 files! Sorry!")
+        print("\tMove the maps in the same folder as the program and try again!")
+    else:
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        run_batch(process_map, file_list, out_path, workers, label='Map', per_run=True, products=products, rois=rois, profile=profile)
+
+    print('\t ☆ Have a nice day ☆ \n')
+
+if __name__ == "__main__":
+    parser = batch_arguments('Read each XRF map once and write all the selected products.')
+    parser.add_argument('--products', nargs='+', choices=PRODUCTS, default=list(PRODUCTS))
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default='default',
+                        help='compression and chunk layout of the reshaped spectra (see reshape-cut-rotate_v5)')
+    add_roi_arguments(parser)
+    add_watch_arguments(parser)
+    args = parser.parse_args()
+    if args.watch:
+        watch(process_map, args.watch, args.watch + NEW_FOLDER, args.workers, label='Map', poll=args.poll, per_run=True,
+              products=args.products, rois=rois_from_arguments(args), profile=args.profile)
+    else:
+        run(args.products, rois_from_arguments(args), args.workers, args.profile)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Lazy access to a raw XRF map, as if it had been cut, reshaped and rotated by reshape-cut-rotate_v5,
+# without writing the reshaped file:
+#
+#   from mapfile import MapFile
+#   with MapFile('map.h5') as m:
+#       print(m.shape)                               # (rows, cols) of the reshaped map
+#       region = m['SDD#1-Spectra'][10:20, 30:50]    # (10, 20, channels)
+#       fe_map = m['SDD#1-Spectra'][:, :, 600:645].sum(axis=-1)
+#       i0 = m['BMS-3-Average'][...]
+#
+# The cut and the 90° rotation are applied to the indices: only the pixels and channels asked for are read.
+# Lists of indices select along each axis independently, as in h5py (m[...][[1, 5], :, [7, 3]] has shape (2, cols, 2)).
+
+import h5py
+import math
+import numpy as np
+
+from h5_io import dataset_view
+from h5_map_handling_v2 import check_bms, find_beam_dumps, get_name_and_date, map_geometry
+
+PATH_SCALAR = "/Measurement/TransientScalarData/"
+PATH_VECTOR = "/Measurement/TransientVectorData/"
+I0_MONITOR = "BMS-T-Average"
+
+
+# indices (array) of an axis of length n selected by key, and whether the axis is kept
+def _axis_indices(key, n):
+    if isinstance(key, (int, np.integer)):
+        if not -n <= key < n:
+            raise IndexError('index %d is out of bounds for axis with size %d' %(key, n))
+        return np.array([key % n]), False
+    return np.arange(n)[key], True
+
+
+# the channels of key, as an h5py selection (slice or increasing list) and the reordering needed afterwards
+def _channel_selection(key, n):
+    if isinstance(key, slice) and (key.step is None or key.step > 0):
+        return key, None, True
+    channels, keep = _axis_indices(key, n)
+    unique, inverse = np.unique(channels, return_inverse=True)
+    return list(unique), inverse, keep
+
+
+class MapView:
+    """A dataset of the map, indexed as the reshaped map: [row, col] or [row, col, channel]."""
+
+    def __init__(self, mapfile, dset):
+        self.mapfile = mapfile
+        self.dset = dset
+        self.data = dataset_view(dset)
+        self.shape = mapfile.shape + dset.shape[1:]
+        self.dtype = dset.dtype
+        self.ndim = len(self.shape)
+
+    def __repr__(self):
+        return '<MapView %s: shape %s, %s>' %(self.dset.name, self.shape, self.dtype)
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[...], dtype=dtype)
+
+    # pixels (flat indices of the raw dataset) and channel selection -> array of shape (pixels,) + channels
+    def _read(self, pixels, channels):
+        order = np.argsort(pixels, kind='stable')
+        unique, inverse = np.unique(pixels[order], return_inverse=True)
+        # consecutive pixels are read as a single hyperslab
+        breaks = np.flatnonzero(np.diff(unique) != 1) + 1
+        blocks = []
+        for run in np.split(unique, breaks):
+            blocks.append(self.data[(slice(int(run[0]), int(run[-1]) + 1),) + channels])
+        values = np.concatenate(blocks) if len(blocks) > 1 else np.asarray(blocks[0])
+        out = np.empty_like(values)
+        out[order] = values[inverse]
+        return out
+
+    def __getitem__(self, key):
+        if key is Ellipsis:
+            key = ()
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),)*(self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError('too many indices: the map has %d dimensions' %self.ndim)
+        key = key + (slice(None),)*(self.ndim - len(key))
+
+        rows, keep_rows = _axis_indices(key[0], self.shape[0])
+        cols, keep_cols = _axis_indices(key[1], self.shape[1])
+        pixels = self.mapfile.pixel_index(rows[:, np.newaxis], cols[np.newaxis, :]).ravel()
+
+        channels, inverse, keep_channels = (), None, True
+        if self.ndim == 3:
+            selection, inverse, keep_channels = _channel_selection(key[2], self.shape[2])
+            channels = (selection,)
+        values = self._read(pixels, channels)
+        if inverse is not None:
+            values = values[:, inverse]
+
+        values = values.reshape((len(rows), len(cols)) + values.shape[1:])
+        if self.ndim == 3 and not keep_channels:
+            values = values[..., 0]
+        if not keep_cols:
+            values = values[:, 0]
+        if not keep_rows:
+            values = values[0]
+        return values
+
+
+class MapFile:
+    """Raw XRF map seen as the reshaped (cut and rotated) map of reshape-cut-rotate_v5.
+
+    shape is (rows, cols) of the reshaped map; m[name] gives a MapView of a dataset of
+    TransientVectorData (rows, cols, channels) or TransientScalarData (rows, cols).
+    """
+
+    def __init__(self, file_name, run=None):
+        self.file = h5py.File(file_name, 'r')
+        # the sample name and date are those of the run (the first one if None)
+        self.run, self.sample_name, self.date = get_name_and_date(self.file, run)
+        self.geometry = map_geometry(self.file, self.run)
+        self.rotate = self.geometry['move_ver_first']
+
+        bms = np.array(self.file[self.run+PATH_SCALAR+I0_MONITOR][...])
+        self.beam_lost, self.valid_pixels, self.comments = check_bms(bms, '')
+        self.with_beam = find_beam_dumps(bms)[0]
+
+        # same shape as reshape-cut-rotate_v5: one row for each complete line of the fast motor
+        self.col = self.geometry['shape'][1]
+        self.row = math.floor(self.valid_pixels/self.col)
+        self.shape = (self.col, self.row) if self.rotate else (self.row, self.col)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<MapFile %s: %s, shape %s%s>' %(self.file.filename, self.sample_name, self.shape,
+                                                ', rotated' if self.rotate else '')
+
+    def keys(self):
+        return list(self.file[self.run+PATH_VECTOR].keys()) + list(self.file[self.run+PATH_SCALAR].keys())
+
+    def __getitem__(self, name):
+        for path in (PATH_VECTOR, PATH_SCALAR):
+            if name in self.file[self.run+path]:
+                return MapView(self, self.file[self.run+path+name])
+        raise KeyError('%s not found in %s' %(name, self.run))
+
+    # index of the raw (flat) dataset for the pixel [i, j] of the reshaped map.
+    # Rotated maps: np.rot90(v, -1, axes=(1,0)) puts the raw pixel [r, c] of the (row, col) map at [col-1-c, r].
+    def pixel_index(self, i, j):
+        if self.rotate:
+            return j*self.col + (self.col - 1 - i)
+        return i*self.col + j
+
+    # (rows, cols) map, True for the pixels collected with beam (Beam_mask of reshape-cut-rotate_v5)
+    def beam_mask(self):
+        i, j = np.indices(self.shape)
+        return self.with_beam[self.pixel_index(i, j)]
@@ -18,23 +18,28 @@ import h5py
 import numpy as np
 import os
 
+from h5_batch import batch_arguments, run_batch
+from h5_io import dataset_view
+from h5_map_handling_v2 import for_each_run, get_name_and_date, run_suffix
+from h5_watch import add_watch_arguments, watch
+
 EXT = "h5"
 PATH_SCALAR = "/Measurement/TransientScalarData"
 PATH_VECTOR = "/Measurement/TransientVectorData"
 NEW_FOLDER = "/cumulative_normalised/"
 I0_MONITOR = "/BMS-3-Average/"
+# pixels read at once from each spectra dataset
+BLOCK_PIXELS = 4096
 
-def get_name_and_date(h5file):
-    key = list(h5file.keys())[0]
-    
-    date_str = 'Run%Y%m%d %H%M%S'
-    # the first part of the string contains date and time of acquisition
-    date_acq = datetime.strptime(key[:18], date_str) 
-    # the rest of the string is the sample_name
-    sample_name = key[19:]
-    
-    # check which detector was used in the ScalarData folder
-    scalar = h5file[key+PATH_SCALAR].keys()
+# (spectra, LiveTime) of each element of the fluorescence detectors
+DETECTOR_ELEMENTS = {'Bruker': [('SDD#1-Spectra', 'SDD#1-LiveTime')],
+                     'Sirius': [('SIRIUS3-UP-Spectrum', 'SIRIUS3-UP-LiveTime'),
+                                ('SIRIUS3-MID-Spectrum', 'SIRIUS3-MID-LiveTime'),
+                                ('SIRIUS3-DOWN-Spectrum', 'SIRIUS3-DOWN-LiveTime')]}
+
+# which fluorescence detector was used: checks the LiveTime in the ScalarData folder
+def fluo_detector(h5file, run):
+    scalar = h5file[run+PATH_SCALAR].keys()
     
     if 'SDD#1-LiveTime' in scalar:
         print('\tBruker found.')
@@ -44,125 +49,90 @@ def get_name_and_date(h5file):
         print('\tSirius3 found.')
         fluo_det = 'Sirius'
 
-    return sample_name, date_acq, fluo_det
+    return fluo_det
 
-def normalise_to_livetime_BRUKER(h5file):
-    print('\tNormalising to Bruker LiveTime.')
-    run = list(h5file.keys())[-1]
-    livetime = np.array(h5file[run+PATH_SCALAR+'/SDD#1-LiveTime/'][...])
-    livetime = livetime.reshape(-1,1)
-    # avoid division by 0
-    livetime = np.where(livetime==0, 1e-5, livetime)
-    
-    norm_data = np.array(h5file[run+PATH_VECTOR+'/SDD#1-Spectra/'][...])
-    norm_data = np.divide(norm_data, livetime)
-   
-    return norm_data
-
-def normalise_to_livetime_SIRIUS(h5file):
-    print('\tNormalising to Sirius LiveTime.')
-    run = list(h5file.keys())[-1]
-    # reading LiveTime 
+def read_livetime(h5file, run, name):
+    # reshaped files keep the LiveTime with the motor positions
     try:
-        u_lt = np.array(h5file[run+PATH_SCALAR+"/SIRIUS3-UP-LiveTime"][...])
-        m_lt = np.array(h5file[run+PATH_SCALAR+"/SIRIUS3-MID-LiveTime"][...])
-        d_lt = np.array(h5file[run+PATH_SCALAR+"/SIRIUS3-DOWN-LiveTime"][...])
-        
+        livetime = np.array(h5file[run+PATH_SCALAR+"/"+name][...])
     except KeyError:
-        u_lt = np.array(h5file[run+"/Motor_positions/SIRIUS3-UP-LiveTime"][...])
-        m_lt = np.array(h5file[run+"/Motor_positions/SIRIUS3-MID-LiveTime"][...])
-        d_lt = np.array(h5file[run+"/Motor_positions/SIRIUS3-DOWN-LiveTime"][...])
-    
-    u_lt = u_lt.reshape(-1,1)
-    m_lt = m_lt.reshape(-1,1)
-    d_lt = d_lt.reshape(-1,1)
-    
+        livetime = np.array(h5file[run+"/Motor_positions/"+name][...])
+    livetime = livetime.reshape(-1)
     # avoiding division by 0
-    u_lt = np.where(u_lt==0, 1e-5, u_lt)
-    m_lt = np.where(m_lt==0, 1e-5, m_lt)
-    d_lt = np.where(d_lt==0, 1e-5, d_lt)
-    
-    data_u = np.array(h5file[run+PATH_VECTOR+"/SIRIUS3-UP-Spectrum"][...])
-    data_m = np.array(h5file[run+PATH_VECTOR+"/SIRIUS3-MID-Spectrum"][...])
-    data_d = np.array(h5file[run+PATH_VECTOR+"/SIRIUS3-DOWN-Spectrum"][...])
-    
-    data_u = np.divide(data_u, u_lt)
-    data_m = np.divide(data_m, m_lt)
-    data_d = np.divide(data_d, d_lt)
+    return np.where(livetime==0, 1e-5, livetime)
+
+# Divides a block of spectra by the LiveTime and by the i0 of each pixel.
+# The block is converted to float once, then the corrections are applied in place.
+def normalise_block(data, livetime, i0):
+    block = np.array(data, dtype=np.float64)
+    np.divide(block, livetime.reshape(-1,1), out=block)
+    np.divide(block, i0.reshape(-1,1), out=block)
+    return block
+
+# Cumulative spectrum normalised to LiveTime, i0 and pixel number.
+# The spectra of each element are read once, BLOCK_PIXELS pixels at a time, and added to a single
+# running spectrum: memory depends on the block size and on the number of channels, not on the map size.
+def accumulate_normalised(h5file, fluo_det, run):
+    print('\tNormalising to %s LiveTime and i0.' %fluo_det)
+    i0 = np.array(h5file[run+PATH_SCALAR+I0_MONITOR][...]).reshape(-1)
+
+    norm_spec = None
+    for spectra_name, livetime_name in DETECTOR_ELEMENTS[fluo_det]:
+        livetime = read_livetime(h5file, run, livetime_name)
+        spectra = dataset_view(h5file[run+PATH_VECTOR+"/"+spectra_name])
+        pixels = spectra.shape[0]
+        if norm_spec is None:
+            norm_spec = np.zeros(spectra.shape[-1])
+
+        for start in range(0, pixels, BLOCK_PIXELS):
+            stop = min(start + BLOCK_PIXELS, pixels)
+            block = normalise_block(spectra[start:stop], livetime[start:stop], i0[start:stop])
+            norm_spec += block.sum(axis=0)
 
-    # summing the normalised spectra of the 3 elements
-    sum_norm_spec = data_u + data_m + data_d
-    
-    return sum_norm_spec
-    
+    # normalising to the pixels number
+    norm_spec /= pixels
+    return norm_spec
 
-def norm_bms_and_sum(h5file, data):
-    # normalising to the i0
-    run = list(h5file.keys())[-1]
-    i0 = np.array(h5file[run+PATH_SCALAR+I0_MONITOR][...])
-    i0 = i0.reshape(-1,1)
-    norm_data = np.divide(data, i0)
 
-    # normalising to the pixels number
-    pixels = np.shape(data)[0]
-    norm_data = np.sum(norm_data, axis=0)
-    norm_data /= pixels
-
-    return norm_data
-
-
-def warning(message, indent = 1, width = None, title = None):
-    indent = 2
-    lines = message.split('\n')
-    space = ' ' * indent
-    if not width:
-        width = max(map(len, lines)) 
-    box = f'╔{"═" * (width + indent * 2)}╗\n'  # upper_border
-    if title:
-        box += f'║{space}{title:<{width}}{space}║\n'  # title
-        box += f'║{space}{"-" * len(title):<{width}}{space}║\n'  # underscore
-    box += ''.join([f'║{space}{line:<{width}}{space}║\n' for line in lines])
-    box += f'╚{"═" * (width + indent * 2)}╝'  # lower_border
-    print(box)
+def write_cumulative_txt(sum_norm_txt, norm_spec, comment_line):
+    fout = open(sum_norm_txt, 'w')
+    
+    fout.write(comment_line)
+    fout.write('#Normalised fluo counts\n')
+    for i in range(len(norm_spec)):
+        fluo_i = "{:.3E}".format(norm_spec[i])
+        fout.write(fluo_i+'\n')
+    
+    fout.close()
 
 ############################################### main method
 
-def normalise_h5(in_file, out_fold):
-    
+# run: key of the run; by default all the runs of the file, one cumulative spectrum for each run
+def normalise_h5(in_file, out_fold, run=None):
+    if run is None:
+        return for_each_run(normalise_h5, in_file, out_fold)
+
     f = h5py.File(in_file, 'r')
     move_ver = False
     comment_line = '#This file has been generated with the script to normalise by the i0, LiveTime and pixels number.\n'      
     today = datetime.today().date()
     comment_line += today.strftime('#The original file was processed on: %d/%m/%Y.\n')
 
-    sample_name, date_acq, fluo_det = get_name_and_date(f)
+    run, sample_name, date_acq = get_name_and_date(f, run)
+    fluo_det = fluo_detector(f, run)
 
-    sum_norm_txt = './'+ NEW_FOLDER + sample_name
-    sum_norm_txt += '_cumulative_norm.txt'           
-    fout = open(sum_norm_txt, 'w')
+    sum_norm_txt = os.path.join(out_fold, sample_name + run_suffix(f, run) + '_cumulative_norm.txt')
     
-    fout.write(comment_line)
-    
-    # Normalising your data to the LiveTime of the fluo detector
-    if fluo_det == 'Bruker':
-        norm_spec = normalise_to_livetime_BRUKER(f)
-    elif fluo_det == 'Sirius':
-        norm_spec = normalise_to_livetime_SIRIUS(f)
-    
-    # Normalising your data to the i0 and pixel number
-    norm_spec = norm_bms_and_sum(f, norm_spec)
+    # Normalising your data to the LiveTime of the fluo detector, the i0 and pixel number
+    norm_spec = accumulate_normalised(f, fluo_det, run)
    
-    fout.write('#Normalised fluo counts\n')
-    for i in range(len(norm_spec)):
-        fluo_i = "{:.3E}".format(norm_spec[i])
-        fout.write(fluo_i+'\n')
-    
-    fout.close()
+    write_cumulative_txt(sum_norm_txt, norm_spec, comment_line)
     f.close()
+    return [sum_norm_txt]
     
 ####################################################################
 
-def run():
+def run(workers=None):
     print('\n')
     print('\t-------------------------------------------------\n')
     print('\t---------           Welcome!         ------------\n')
@@ -191,13 +161,17 @@ def run():
         if not os.path.exists(out_path):
             os.makedirs(out_path)
 
-        for filename, i in zip(file_list, range(len(file_list))):
-            print('\tOpening file:',filename)
-            filename = filename[2:]
-            normalise_h5(filename, out_path)
-            print('\n- - - - Spectrum {0}/{1} successfully extracted.\n'.format(i+1, len(file_list)))
+        file_list = [filename[2:] for filename in file_list]
+        run_batch(normalise_h5, file_list, out_path, workers, label='Spectrum', per_run=True)
 
     print('\t ☆ Have a nice day ☆ \n')
 
 if __name__ == "__main__":
-    run()
+    parser = batch_arguments('Calculate the normalised cumulative spectrum of the XRF maps in the current folder.')
+    add_watch_arguments(parser)
+    args = parser.parse_args()
+    if args.watch:
+        watch(normalise_h5, args.watch, args.watch + NEW_FOLDER, args.workers, label='Spectrum', poll=args.poll,
+              per_run=True)
+    else:
+        run(args.workers)
@@ -3,7 +3,7 @@
 
 __author__  = "Ilaria Carlomagno"
 __license__ = "MIT"
-__version__ = "5.2"
+__version__ = "5.3"
 __email__ = "ilaria.carlomagno@elettra.eu"
 
 #This script does 5 things:
@@ -20,8 +20,15 @@ import h5py
 import math
 import numpy as np
 import os
+import time
 
-from h5_map_handling import check_bms, count_steps, get_name_and_date, orientation, read_positions, warning
+from deadtime import deadtime_comments, map_deadtime, write_deadtime_maps
+from h5_batch import batch_arguments, run_batch
+from h5_manifest import add_manifest_arguments
+from h5_map_handling_v2 import __version__ as h5_map_version
+from h5_map_handling_v2 import BMS_MIN, CHUNK_LAYOUTS, CODECS, OUTPUT_PROFILES, PRECISION, check_bms, dataset_report, find_beam_dumps, for_each_run, get_name_and_date, map_geometry, output_profile, reshape_scalar, warning, write_report, write_vector_to_h5, write_virtual_to_h5
+from h5_live import IDLE, live_reshape
+from h5_watch import add_watch_arguments, watch
 
 EXT = "h5"
 PATH_SCALAR = "/Measurement/TransientScalarData"
@@ -29,60 +36,87 @@ PATH_VECTOR = "/Measurement/TransientVectorData"
 POSITIONERS = "/Measurement/Positioners"
 NEW_FOLDER = "/cut-reshaped/"
 I0_MONITOR = "/BMS-T-Average"
+# Spectra are streamed in blocks of map rows: at most MEMORY_BUDGET bytes are held in memory at once.
+# Set it to None to load each dataset whole (old behaviour).
+MEMORY_BUDGET = 256 * 1024**2
 
 # The motor positions copied to the output file are the following:
 AcceptedList = ['BMS-3-Average','DIODE-Average','X','Y','Z']
 # aggiungi LiveTime!
 
-def cut_reshape(in_file, out_fold):
-    
+# With virtual=True the reshaped datasets are HDF5 virtual datasets pointing to the original file:
+# nothing is copied, but the output can only be opened while the original file is at the same relative path.
+# Rotated maps are always copied.
+# profile: compression and chunks of the spectra, a name from OUTPUT_PROFILES or a dictionary (see output_profile).
+# A report with the compression ratio and write time of each dataset is saved next to the new file.
+# run: key of the run to reshape; by default all the runs of the file, one after the other
+# (each run is a separate map, with its own date and output file).
+def cut_reshape(in_file, out_fold, memory_budget=MEMORY_BUDGET, virtual=False, profile='default', run=None):
+    if run is None:
+        return for_each_run(cut_reshape, in_file, out_fold, memory_budget=memory_budget, virtual=virtual,
+                            profile=profile)
+
     f = h5py.File(in_file, 'r')
+    try:
+        return _cut_reshape_run(f, out_fold, memory_budget, virtual, profile, run)
+    finally:
+        f.close()
+
+
+def _cut_reshape_run(f, out_fold, memory_budget, virtual, profile, run):
     move_ver = False
     comment_line = 'This file has been generated with the script reshape-cut-rotate_V5.\n'      
     today = datetime.date.today() 
     comment_line += today.strftime('The original file was processed on: %d/%m/%Y.\n')
 
-    run, sample_name, date_acq = get_name_and_date(f)
+    run, sample_name, date_acq = get_name_and_date(f, run)
 
-    new_map = './'+ NEW_FOLDER + sample_name + date_acq.strftime('_%Y-%m-%d_%H-%M-%S')
+    new_map = os.path.join(out_fold, sample_name + date_acq.strftime('_%Y-%m-%d_%H-%M-%S'))
 
     print("Sample_name: %s." %sample_name)
     print(date_acq.strftime('\tAcquisition time: %d/%m/%Y - %H:%M:%S.'))
     
+    # map shape and orientation from the motor positions (cached next to the h5 file)
     try:                
-        x, y = read_positions(f, str(run+PATH_SCALAR))
+        geometry = map_geometry(f, run)
     except KeyError:
         warning('HOR/VER movement not found! Moving on!')
         return None
-    except TypeError:
-        return None
-    # check the map orientation and corrects for it, if necessary 
-    try:
-        x, y, move_ver = orientation(x, y)            
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
-    shape_x, shape_y = count_steps(x), count_steps(y)
+    move_ver = geometry['move_ver_first']
+    if move_ver:
+        print('\tX (VER) moved first: the map will be rotated to fix data visualization on PyMCA.')
+    if geometry['snake']:
+        print('\t⚠ Snake scan: every other line was collected backwards (lines are not flipped).')
+        comment_line += 'Snake scan: every other line was collected backwards and has not been flipped.\n'
+
+    # shape_x = positions of the slow motor, shape_y = positions of the fast motor
+    shape_x, shape_y = geometry['shape']
     tot_points_raw = shape_x * shape_y
 
     print("\tOriginal map shape: (%d, %d), points = %d." %(shape_x, shape_y, tot_points_raw) )
 
     # check for beam dump on the I0 signal (BMS)
     bms = np.array(f[run+PATH_SCALAR+I0_MONITOR][...])
-    beam_lost, valid_pixels, comment_line = check_bms(bms, comment_line)
+    try:
+        beam_lost, valid_pixels, comment_line = check_bms(bms, comment_line)
+    except ValueError:
+        # no pixel with beam: nothing to reshape
+        return None
+    with_beam, segments = find_beam_dumps(bms)
     
     if valid_pixels == 0:
         warning('No valid pixels, moving on.')
         return None
 
+    # each row of the reshaped map is a line of the fast motor: incomplete lines are discarded
+    col = shape_y
+    row = math.floor(valid_pixels/shape_y)
     if move_ver:
-        row = shape_x
-        col = math.floor(valid_pixels/shape_x)
         new_map += '_rot'
         comment_line += 'This map has been rotated.\n'
-    else:
-        col = shape_y
-        row = math.floor(valid_pixels/shape_y)
                           
     if valid_pixels < shape_x*shape_y:
         print('    !\tValid pixels = %s out of %s' %(valid_pixels, shape_x*shape_y))
@@ -97,45 +131,87 @@ def cut_reshape(in_file, out_fold):
         comment_line += 'This map was not cut. Only reshaping has been done.\n'
         print('\tNew map shape: (%d, %d)' %(row, col))
         
+    if virtual and move_ver:
+        print('\tRotated maps cannot be virtual: the data will be copied.')
+        virtual = False
+    if virtual:
+        new_map += '_virtual'
+        comment_line += 'The data are not copied: this file points to the original file (HDF5 virtual datasets).\n'
+
+    # deadtime of each pixel of the new map, for each element of the detector (see deadtime.py)
+    deadtimes = {element: (deadtime[0:row*col], reference)
+                 for element, (deadtime, reference) in map_deadtime(f, run).items()}
+    for element, (deadtime, reference) in sorted(deadtimes.items()):
+        print('\tDeadtime %s: mean %.1f%%, max %.1f%% (relative to the %s).'
+              %(element, deadtime.mean(), deadtime.max(), reference))
+    comments = deadtime_comments(deadtimes)
+    if comments:
+        for line in comments.splitlines():
+            print('\t⚠ ' + line)
+        comment_line += comments
+
     new_map += '.h5'                              
-    fout =  h5py.File(new_map, 'w')
+    if memory_budget is None:
+        fout =  h5py.File(new_map, 'w')
+    else:
+        # the chunk cache holds the output chunks of a block (blocks are aligned to the chunks, see write_vector_to_h5)
+        fout =  h5py.File(new_map, 'w', rdcc_nbytes=memory_budget)
     final_points = row * col
     
-    fout.create_dataset("Comments", data=comment_line)
-
-    # Reshaping Array-Like Data (e.g. SDD signal)
-    for vectorData in f[run+PATH_VECTOR].keys():
-        v = f[run+PATH_VECTOR+"/"+vectorData][...]
-        v = v[0:final_points]
-        v = v.reshape(row,col,v.shape[-1])                   
-        # the rotation of the map is done here:
-        if move_ver:
-           v = np.rot90(v, -1, axes=(1,0))
-
-        fout.create_dataset(run+"/Detector_data/"+vectorData, data=v, compression = "gzip", shuffle=True)
-
-    # Reshaping 1D data (e.g. motor positions, i0, ...)
-    for scalarData in f[run+PATH_SCALAR].keys():
-        if scalarData in AcceptedList or scalarData.endswith('LiveTime'):                
-            s = f[run+PATH_SCALAR+"/"+scalarData][...]
-            s = s[0:final_points]
-            if s.shape[0] == final_points:
-                s = s.reshape(row, col)
-            
-            if move_ver:
-                s = np.rot90(s, -1, axes=(1,0))
-            
-            fout.create_dataset(run+"/Motor_positions/"+scalarData, data=s)
-
-    # Reshaping Starting positions (motor positions right before map collection)
-    for motor_position in f[run+POSITIONERS].keys():
-        p = f[run+POSITIONERS+"/"+motor_position][...]                   
-        fout.create_dataset(run+"/Starting_positions/"+motor_position, data=p)
+    try:
+        fout.create_dataset("Comments", data=comment_line)
+        report = []
+
+        # Reshaping Array-Like Data (e.g. SDD signal)
+        for vectorData in f[run+PATH_VECTOR].keys():
+            if virtual:
+                write_virtual_to_h5(f[run+PATH_VECTOR+"/"+vectorData], fout, run+"/Detector_data/"+vectorData, row, col)
+                continue
+            start = time.time()
+            # memory_budget=None: the whole map in a single block
+            dset = write_vector_to_h5(f[run+PATH_VECTOR+"/"+vectorData], fout, run+"/Detector_data/"+vectorData,
+                                      row, col, move_ver, memory_budget, profile)
+            report.append(dataset_report(dset, time.time() - start))
+
+        # Reshaping 1D data (e.g. motor positions, i0, ...)
+        for scalarData in f[run+PATH_SCALAR].keys():
+            if scalarData in AcceptedList or scalarData.endswith('LiveTime'):                
+                if virtual and f[run+PATH_SCALAR+"/"+scalarData].shape[0] >= final_points:
+                    write_virtual_to_h5(f[run+PATH_SCALAR+"/"+scalarData], fout, run+"/Motor_positions/"+scalarData, row, col)
+                    continue
+                s = f[run+PATH_SCALAR+"/"+scalarData][...]
+                s = reshape_scalar(s, row, col, move_ver)
+                fout.create_dataset(run+"/Motor_positions/"+scalarData, data=s)
+
+        # Pixels collected without beam but kept in the map (dump and refill during the acquisition)
+        if not with_beam[0:final_points].all():
+            fout.create_dataset(run+"/Motor_positions/Beam_mask", data=reshape_scalar(with_beam, row, col, move_ver))
+            fout.create_dataset(run+"/Motor_positions/Beam_segments", data=np.array(segments, dtype=int).reshape(-1, 2))
+
+        # Deadtime maps (%), reshaped like the spectra: the regions where the detector was saturated at a glance
+        write_deadtime_maps(fout, run, deadtimes, lambda deadtime: reshape_scalar(deadtime, row, col, move_ver))
+
+        # Starting positions (motor positions right before map collection): the whole group is copied by HDF5
+        f.copy(f[run+POSITIONERS], fout, name=run+"/Starting_positions")
+    finally:
+        fout.close()
+
+    outputs = [new_map]
+    if report:
+        write_report(report, profile, new_map[:-3] + '_report.txt')
+        outputs.append(new_map[:-3] + '_report.txt')
+    return outputs
 
 
 ####################################################################
 
-def run():
+# manifest entry of the reshaped maps (see h5_manifest), shared by the batch and the watch mode
+def reshape_manifest(virtual, profile):
+    params = {'BMS_MIN': BMS_MIN, 'PRECISION': PRECISION, 'virtual': virtual, 'profile': profile}
+    return ('reshape', [__version__, h5_map_version], params)
+
+# Maps already reshaped with the same version and parameters are skipped (see h5_manifest), unless force=True.
+def run(workers=None, virtual=False, profile='default', force=False):
     print('\n')
     print('\t-------------------------------------------------\n')
     print('\t---------           Welcome!         ------------\n')
@@ -163,12 +239,37 @@ def run():
         if not os.path.exists(out_path):
             os.makedirs(out_path)        
 
-        for filename, i in zip(file_list, range(len(file_list))):
-            filename = filename[2:]
-            cut_reshape(filename, out_path)
-            print('\n- - - - Map {0}/{1} successfully processed.\n'.format(i+1, len(file_list)))
+        file_list = [filename[2:] for filename in file_list]
+        manifest = reshape_manifest(virtual, profile)
+        run_batch(cut_reshape, file_list, out_path, workers, label='Map', manifest=manifest, force=force,
+                  per_run=True, virtual=virtual, profile=profile)
 
     print('\t ☆ Have a nice day ☆ \n')
 
 if __name__ == "__main__":
-    run()
+    parser = batch_arguments('Cut, reshape and rotate the XRF maps in the current folder.')
+    parser.add_argument('--virtual', action='store_true',
+                        help='write virtual datasets pointing to the original files instead of copying the data (not for rotated maps)')
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default='default',
+                        help='compression and chunk layout of the spectra: default (gzip), fast (lzf, one chunk per row), small (gzip 9, tiles), pixel (one chunk per spectrum), none')
+    parser.add_argument('--codec', choices=CODECS, default=None, help='change the compression of the profile')
+    parser.add_argument('--level', type=int, choices=range(10), default=None, help='change the gzip level of the profile')
+    parser.add_argument('--chunks', choices=CHUNK_LAYOUTS, default=None, help='change the chunk layout of the profile')
+    add_watch_arguments(parser)
+    add_manifest_arguments(parser)
+    parser.add_argument('--live', default=None, metavar='FILE',
+                        help='reshape FILE while it is being acquired (written in SWMR mode), line by line')
+    parser.add_argument('--idle', type=float, default=IDLE,
+                        help='live mode: seconds without new pixels after which the acquisition is considered finished')
+    args = parser.parse_args()
+    profile = output_profile(args.profile, args.codec, args.level, args.chunks)
+    if args.live:
+        out_path = './' + NEW_FOLDER
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        live_reshape(args.live, out_path, args.poll, args.idle, profile)
+    elif args.watch:
+        watch(cut_reshape, args.watch, args.watch + NEW_FOLDER, args.workers, label='Map', poll=args.poll,
+              manifest=reshape_manifest(args.virtual, profile), per_run=True, virtual=args.virtual, profile=profile)
+    else:
+        run(args.workers, args.virtual, profile, args.force)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Integration of any number of ROIs on the fluorescence spectra of a XANES scan.
+# A ROI is given as [first, last] channel (both included), as in the scripts asking for a new ROI.
+# The spectra are summed once along the channels (cumulative sum): the integral of a ROI
+# is then the difference of two columns, for all the points and all the ROIs at the same time.
+# The cumulative sum can be saved next to the h5 file (cached_prefix_sum), so that trying new ROIs
+# does not need to read the spectra again.
+
+import json
+import numpy as np
+import os
+
+from h5_cache import load_sidecar, save_sidecar
+from h5_io import read_array
+
+PREFIX_SIDECAR = '.prefix.json'
+
+
+# "[600, 644]", "600,644" or "600 644" -> [600, 644]
+def parse_roi(text):
+    values = text.replace('[', ' ').replace(']', ' ').replace(',', ' ').split()
+    if len(values) != 2:
+        raise ValueError('A ROI needs the first and the last channel: [first, last], not %r' %text)
+    first, last = int(values[0]), int(values[1])
+    if first > last:
+        first, last = last, first
+    return [first, last]
+
+
+# ROI file: a json list of [first, last] couples, or a text file with one ROI per line ('#' for comments)
+def load_rois(path):
+    with open(path) as rf:
+        text = rf.read()
+    try:
+        return [parse_roi(str(roi)) for roi in json.loads(text)]
+    except ValueError:
+        pass
+    rois = []
+    for line in text.splitlines():
+        line = line.split('#')[0].strip()
+        if line:
+            rois.append(parse_roi(line))
+    return rois
+
+
+def add_roi_arguments(parser):
+    parser.add_argument('--roi', action='append', type=parse_roi, default=[], metavar='FIRST,LAST',
+                        help='first and last channel of a ROI (can be repeated)')
+    parser.add_argument('--roi-file', default=None,
+                        help='file with the ROIs: one "first, last" per line, or a json list')
+    parser.add_argument('--prefix-cache', action='store_true',
+                        help='save the cumulative spectra next to the h5 files and reuse them on the next runs')
+    return parser
+
+
+def rois_from_arguments(args):
+    rois = list(args.roi)
+    if args.roi_file:
+        rois += load_rois(args.roi_file)
+    return rois
+
+
+def roi_name(roi):
+    return '%d-%d' %(roi[0], roi[1])
+
+
+# Cumulative spectrum along the channels, with a leading column of zeros:
+# sum(spectra[:, first:last+1]) = prefix[:, last+1] - prefix[:, first]
+def prefix_sum(spectra):
+    spectra = np.asarray(spectra)
+    # integer counts are summed as int64 (exact), anything else as float64
+    dtype = np.int64 if spectra.dtype.kind in 'iub' else np.float64
+    prefix = np.zeros(spectra.shape[:-1] + (spectra.shape[-1] + 1,), dtype=dtype)
+    np.cumsum(spectra, axis=-1, dtype=dtype, out=prefix[..., 1:])
+    return prefix
+
+
+# Integrals of all the ROIs from a prefix sum: array of shape (points, number of ROIs)
+def integrate_prefix(prefix, rois):
+    rois = np.asarray(rois, dtype=int).reshape(-1, 2)
+    channels = prefix.shape[-1] - 1
+    first = np.clip(rois[:, 0], 0, channels)
+    last = np.clip(rois[:, 1] + 1, 0, channels)
+    return prefix[..., last] - prefix[..., first]
+
+
+def integrate_rois(spectra, rois):
+    return integrate_prefix(prefix_sum(spectra), rois)
+
+
+# Prefix sum of the spectra in h5file[path], saved as a .npy file next to the h5 file.
+# The list of saved datasets is kept in a PREFIX_SIDECAR file: if the h5 file changes (size or
+# modification time), the saved prefix sums are ignored and computed again.
+# The saved array is memory-mapped: a ROI only reads the two columns it needs.
+def cached_prefix_sum(h5file, path):
+    file_name = h5file.filename
+    folder = os.path.dirname(os.path.abspath(file_name))
+    cache = load_sidecar(file_name, PREFIX_SIDECAR) or {'datasets': {}}
+
+    if path in cache['datasets']:
+        try:
+            return np.load(os.path.join(folder, cache['datasets'][path]), mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+    prefix = prefix_sum(read_array(h5file[path]))
+
+    npy_name = '%s.%s.prefix.npy' %(os.path.basename(file_name), path.strip('/').replace('/', '_'))
+    tmp_name = os.path.join(folder, 'tmp%d_%s' %(os.getpid(), npy_name))
+    try:
+        np.save(tmp_name, prefix)
+        os.replace(tmp_name, os.path.join(folder, npy_name))
+    except OSError:
+        # read-only folder: the prefix sum is used for this run only
+        return prefix
+    cache['datasets'][path] = npy_name
+    save_sidecar(file_name, PREFIX_SIDECAR, cache)
+    return prefix
+
+
+# absorption coefficient for each ROI: integral / I0
+def alfafluo(integrals, i0):
+    return integrals / np.asarray(i0, dtype=float).reshape(-1, 1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__  = "Ilaria Carlomagno"
+__license__ = "MIT"
+__version__ = "1.0"
+__email__   = "ilaria.carlomagno@elettra.eu"
+
+# Synthetic h5 files with the same layout as the ones collected at the XRF beamline,
+# to test and benchmark the scripts without beamtime data.
+# 1) XRF maps: 'Run%Y%m%d %H%M%S <sample>' with Measurement/TransientScalarData, TransientVectorData
+#    and Positioners, for the Bruker (SDD#1) or the Sirius3 (UP/MID/DOWN) detector.
+#    Beam dumps (with or without refill), interrupted maps and column-first scans can be simulated.
+# 2) XANES scans: monomoto/energy, bms/current, sirius3/* and bruker/* as read by the XANES scripts.
+#
+# usage: python synthetic_h5.py map out.h5 --rows 100 --cols 200 [--detector sirius] [--column-first] ...
+#        python synthetic_h5.py xanes Fe_scan.h5 --points 300
+
+import argparse
+from datetime import datetime, timedelta
+import h5py
+import numpy as np
+
+CHANNELS = 2048
+PATH_SCALAR = "/Measurement/TransientScalarData/"
+PATH_VECTOR = "/Measurement/TransientVectorData/"
+POSITIONERS = "/Measurement/Positioners/"
+SIRIUS_ELEMENTS = ('UP', 'MID', 'DOWN')
+# pixels generated and written at once
+BLOCK_PIXELS = 4096
+
+
+# Average spectrum: a few fluorescence lines on a small background, with `counts` counts in total.
+def _mean_spectrum(channels, counts):
+    ch = np.arange(channels)
+    spectrum = np.full(channels, 0.2)
+    for centre, width, height in ((0.31, 0.006, 10.), (0.34, 0.006, 2.), (0.21, 0.005, 4.), (0.68, 0.01, 1.)):
+        spectrum += height * np.exp(-0.5*((ch - centre*channels)/(width*channels))**2)
+    return spectrum * counts / spectrum.sum()
+
+
+# X (VER) and Y (HOR) positions of a map: rows x cols pixels, horizontal lines unless column_first.
+def map_positions(rows, cols, column_first=False, snake=False, step_x=0.005, step_y=0.005):
+    if column_first:
+        hor, ver = np.meshgrid(np.arange(cols), np.arange(rows), indexing='ij')
+    else:
+        ver, hor = np.meshgrid(np.arange(rows), np.arange(cols), indexing='ij')
+    fast = ver if column_first else hor
+    if snake:
+        fast[1::2] = fast[1::2, ::-1]
+    return 10. + ver.ravel()*step_x, -5. + hor.ravel()*step_y
+
+
+def make_map(file_name, rows=50, cols=60, channels=CHANNELS, detector='bruker', column_first=False, snake=False,
+             beam_dump=None, refill=False, stop_at=None, counts=500, compression='gzip', sample='synthetic',
+             date=None, runs=1, seed=0):
+    """Writes a synthetic XRF map.
+
+    beam_dump: fraction of the map (0-1) where the beam is lost; with refill=True the beam comes back
+    after 5% of the pixels, otherwise it is lost until the end. stop_at: fraction of the map collected
+    before a manual interruption. runs: number of runs (keys) in the file.
+    """
+    rng = np.random.default_rng(seed)
+    date = date or datetime(2023, 4, 5, 10, 11, 12)
+    mean = _mean_spectrum(channels, counts)
+
+    with h5py.File(file_name, 'w') as f:
+        for r in range(runs):
+            key = (date + timedelta(minutes=r)).strftime('Run%Y%m%d %H%M%S ') + sample + ('' if runs == 1 else '_%d' %r)
+            x, y = map_positions(rows, cols, column_first, snake)
+            points = len(x) if stop_at is None else int(len(x)*stop_at)
+            x, y = x[0:points], y[0:points]
+
+            bms = 0.5 + 0.01*rng.standard_normal(points)
+            if beam_dump is not None:
+                start = int(points*beam_dump)
+                stop = min(points, start + max(1, points//20)) if refill else points
+                bms[start:stop] = 1e-6
+
+            scalar = f.create_group(key + PATH_SCALAR)
+            scalar['X'] = x
+            scalar['Y'] = y
+            scalar['Z'] = np.full(points, 1.5)
+            scalar['BMS-T-Average'] = bms
+            scalar['BMS-3-Average'] = bms
+            scalar['DIODE-Average'] = bms * 0.1
+
+            vector = f.create_group(key + PATH_VECTOR)
+            vector['BMS-3'] = np.repeat(bms[:, np.newaxis], 4, axis=1)
+            vector['BMS-T'] = np.repeat(bms[:, np.newaxis], 4, axis=1)
+
+            if detector == 'bruker':
+                elements = [('SDD#1-Spectra', 'SDD#1-LiveTime')]
+            else:
+                elements = [('SIRIUS3-%s-Spectrum' %e, 'SIRIUS3-%s-LiveTime' %e) for e in SIRIUS_ELEMENTS]
+
+            for spectra_name, livetime_name in elements:
+                livetime = np.clip(0.9 + 0.02*rng.standard_normal(points), 0.5, 1.)
+                scalar[livetime_name] = livetime
+                options = {'compression': compression, 'shuffle': True} if compression else {}
+                spectra = vector.create_dataset(spectra_name, shape=(points, channels), dtype='<u4',
+                                                chunks=(min(points, 64), channels) if compression else None, **options)
+                for start in range(0, points, BLOCK_PIXELS):
+                    stop = min(start + BLOCK_PIXELS, points)
+                    scale = (bms[start:stop]/0.5 * livetime[start:stop])[:, np.newaxis]
+                    spectra[start:stop] = rng.poisson(mean * scale)
+
+            positioners = f.create_group(key + POSITIONERS)
+            positioners['X'] = np.float64(x[0])
+            positioners['Y'] = np.float64(y[0])
+            positioners['Z'] = np.float64(1.5)
+    return file_name
+
+
+def make_xanes(file_name, points=300, channels=CHANNELS, e0=7112., counts=2000, seed=0):
+    """Writes a synthetic XANES scan with both the Sirius3 and the Bruker data."""
+    rng = np.random.default_rng(seed)
+    energy = np.linspace(e0 - 50, e0 + 150, points)
+    edge = 1 + 0.5*(1 + np.tanh((energy - e0)/3.))
+    mean = _mean_spectrum(channels, counts)
+
+    with h5py.File(file_name, 'w') as f:
+        f['triggers'] = np.arange(points)
+        f['monomoto/energy'] = energy
+        f['monomoto/incidenceangle'] = np.full(points, 45.)
+        f['monomoto/incidencemotor'] = np.full(points, 1.)
+        f['monomoto/crystalseparation'] = np.full(points, 10.)
+        i0 = 1 + 0.01*rng.standard_normal(points)
+        f['bms/current'] = i0
+        f['bms/background'] = np.zeros(points)
+        f['bms/bms_channel'] = 3
+        f['bms/bms_secondary_channel'] = 0
+
+        spectra = rng.poisson(mean * (edge*i0)[:, np.newaxis]).astype('<u4')
+        f.create_dataset('sirius3/sum_spectrum', data=spectra, compression='gzip', shuffle=True)
+        for e in SIRIUS_ELEMENTS:
+            f['sirius3/%s_deadtimepct' %e.lower()] = np.abs(3 + rng.standard_normal(points))
+        f.create_dataset('bruker/spectrum', data=spectra, compression='gzip', shuffle=True)
+        f['bruker/acquisitiontime'] = 1.
+        f['bruker/livetime'] = np.clip(0.95 + 0.01*rng.standard_normal(points), 0, 1)
+    return file_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic h5 files with the layout of the XRF beamline.')
+    kind = parser.add_subparsers(dest='kind', required=True)
+
+    m = kind.add_parser('map', help='XRF map')
+    m.add_argument('file_name')
+    m.add_argument('--rows', type=int, default=50)
+    m.add_argument('--cols', type=int, default=60)
+    m.add_argument('--channels', type=int, default=CHANNELS)
+    m.add_argument('--detector', choices=('bruker', 'sirius'), default='bruker')
+    m.add_argument('--column-first', action='store_true', help='vertical motor moving first (map to be rotated)')
+    m.add_argument('--snake', action='store_true', help='every other line collected backwards')
+    m.add_argument('--beam-dump', type=float, default=None, help='fraction of the map where the beam is lost')
+    m.add_argument('--refill', action='store_true', help='the beam comes back after the dump')
+    m.add_argument('--stop-at', type=float, default=None, help='fraction of the map collected before interruption')
+    m.add_argument('--runs', type=int, default=1, help='number of runs in the file')
+    m.add_argument('--no-compression', action='store_true')
+    m.add_argument('--sample', default='synthetic')
+
+    x = kind.add_parser('xanes', help='XANES scan')
+    x.add_argument('file_name')
+    x.add_argument('--points', type=int, default=300)
+    x.add_argument('--channels', type=int, default=CHANNELS)
+
+    args = parser.parse_args()
+    if args.kind == 'map':
+        make_map(args.file_name, args.rows, args.cols, args.channels, args.detector, args.column_first, args.snake,
+                 args.beam_dump, args.refill, args.stop_at, compression=None if args.no_compression else 'gzip',
+                 sample=args.sample, runs=args.runs)
+    else:
+        make_xanes(args.file_name, args.points, args.channels)
+    print('Saved file', args.file_name)
@@ -0,0 +1,47 @@
+import h5py
+import numpy as np
+
+import convert_h5_to_orange
+from synthetic_h5 import make_map
+
+PATH_SCALAR = convert_h5_to_orange.PATH_SCALAR
+PATH_VECTOR = convert_h5_to_orange.PATH_VECTOR
+
+
+# the writer of the original script (one pixel and one channel at a time), as reference.
+# Each value is written with its numpy text, as the original script did under Python 2: with
+# Python 3, format() of a numpy float goes through the python float (0.10000000149011612 for a float32 0.1).
+def old_csv(map_name, txt_file):
+    with h5py.File(map_name, 'r') as f, open(txt_file, 'w') as txt:
+        run = list(f.keys())[0]
+        x = f[run+PATH_SCALAR+"X"][...]
+        y = f[run+PATH_SCALAR+"Y"][...]
+        bms = f[run+PATH_VECTOR+convert_h5_to_orange.BMS_channel][...]
+        bms = bms.mean(axis=1)
+        spectra = f[run+PATH_VECTOR+"SDD#1-Spectra"][...]
+        pixels = list(zip(x, y, bms))
+        txt.write('# x, y, bms, spectrum')
+        for i in range(len(x)):
+            txt.write('\n{},{},{}'.format(*map(str, pixels[i])))
+            for ch in range(2048):
+                txt.write(',{}'.format(str(spectra[i][ch])))
+
+
+def _float32_positions(map_name):
+    with h5py.File(map_name, 'a') as f:
+        run = list(f.keys())[0]
+        for name in (PATH_SCALAR+"X", PATH_SCALAR+"Y", PATH_VECTOR+convert_h5_to_orange.BMS_channel):
+            values = f[run+name][...].astype(np.float32)
+            del f[run+name]
+            f[run+name] = values
+
+
+def test_csv_float32_same_as_old_writer(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    make_map('m.h5', rows=6, cols=7, channels=2048)
+    _float32_positions('m.h5')
+    old_csv('m.h5', 'old.csv')
+
+    convert_h5_to_orange.convert('m.h5', str(tmp_path))
+    with open('old.csv') as old, open('m.csv') as new:
+        assert new.read() == old.read()